@@ -6,37 +6,12 @@
 import os
 import sys
 
-# Dependencies - other
-from functools import reduce
-import random
-import math
-import itertools
-from operator import itemgetter
-
-# ------------------------------------------------------------------------------
-#   EXTERNAL DEPENDENCIES
-# ------------------------------------------------------------------------------
-
-# Rasterio - working with raster data
-import rasterio as rio
-from rasterio.plot import plotting_extent
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-import rasterio.transform
-import rasterio.mask
-from rasterio import Affine
-
-# Shapefiles - working with vector data
-import shapely.geometry
-from shapely.ops import cascaded_union
-import geopandas as gpd
-
-# GDAL
-from osgeo import gdal, gdalconst
-
-# Numeric
-import pandas as pd
+# NOTE: Heavy dependencies (e.g. rasterio, geopandas, GDAL and pandas) are not
+# imported here but by the modules that use them, such that lightweight commands
+# (e.g. download_worldpop.py and info_script.py) and worker processes only load
+# what they need. NumPy is available to functions defined below (e.g.
+# population_to_buildings).
 import numpy as np
-from scipy.spatial import cKDTree
 
 
 # ------------------------------------------------------------------------------
@@ -69,6 +44,42 @@ area_crs = "EPSG:3035" # Suitable for EU
 adm_level = 1
 field_name = f"ID_{adm_level}"
 
+# Method used to associate raster pixels with admin bounds; "rasterize" burns
+# all admin bounds into a label grid in a single pass, "windowed" does the same
+# one block of rows at a time (for rasters that do not fit in memory, e.g. 100m
+# WorldPop), whereas "mask" masks the raster once per admin bound (slow for fine
+# admin levels)
+grid_method = "rasterize"
+
+# Engine used to aggregate raster data to res - "numpy" aggregates in memory
+# (integer factors by blocks, other factors by area weighting) without writing
+# an intermediate raster, whereas "gdal" resamples with gdal.Translate and
+# caches the result in raster_cache_dir. raster_aggregation is "sum" (preserves
+# population totals), "mean" (as the GDAL "average" resampling used originally,
+# which pop_thresh below was chosen for) or "max"
+raster_engine = "numpy"
+raster_aggregation = "mean"
+
+# Memory ceiling (in MB) for raster processing; used to size the windows read
+# with the "windowed" grid_method and to bound the GDAL block cache
+max_memory_mb = 1024
+
+# Number of worker processes used to sample admin bounds in parallel (1 to
+# sample all bounds in the main process)
+sampling_workers = 1
+
+# Allocation of assets to grid cells - "sample" draws the location of each
+# building at random (with probabilities proportional to count), whereas "exact"
+# splits the buildings of each class across the grid cells of a bound in
+# proportion to count, rounding to whole buildings by the largest remainder
+# method, such that totals are preserved exactly and the cost does not depend on
+# the number of buildings
+allocation = "sample"
+
+# Seed of the random number generator used for sampling, such that runs are
+# reproducible (set to None for a different sample on every run)
+seed = 42
+
 # Threshold for checking that sampled asset counts match original input
 thresh = 0.001
 
@@ -76,12 +87,40 @@ thresh = 0.001
 # NOTE: This function could be adjusted according to needs. Currently,
 # the function assumes that buildings are directly proportional to the
 # estimated population, with a minimum threshold of estimated population
-# applied. Another option, which might be desirable for industrial
-# buildings would be to sample buildings proportional to the square root of
-# the estimated population (which would yield more spread)
+# applied ("threshold"). Other options (see calcs/weighting.py) are "linear"
+# (proportional without threshold), "sqrt" (proportional to the square root of
+# the estimated population above pop_thresh, which might be desirable for
+# industrial buildings as it yields more spread) and "power" (proportional to
+# the estimated population to the power pop_exponent above pop_thresh)
+population_weighting = "threshold"
 pop_thresh = 0.35
-# NOTE: The pop input will be a df column of the population estimates
-population_to_buildings = lambda pop : [x if x > pop_thresh else 0 for x in pop]
+pop_exponent = 0.5
+# NOTE: A custom function can be given instead, whose pop input will be a NumPy
+# array of the population estimates of all grid cells, and which must return
+# an array (e.g. using np.where rather than looping over cells), e.g.
+# population_to_buildings = lambda pop: np.where(pop > pop_thresh, pop, 0)
+population_to_buildings = None
+
+# Covariate rasters used along with the population estimates (e.g. built-up
+# surface, settlement class, night lights), mapping the name of each layer to
+# the path of its raster ({iso} is replaced by the lower case ISO code) and the
+# aggregation used to align it with the resampled population grid ("sum",
+# "mean", "max", "mode" or "nearest"). All layers are associated with admin
+# bounds in a single pass and added to the grid as columns named after them
+# (NaN where a covariate has no data), e.g.
+# covariates = {
+#     "built": (os.path.join("data", "covariates", "{iso}_built_s.tif"), "sum"),
+#     "smod": (os.path.join("data", "covariates", "{iso}_smod.tif"), "mode"),
+#     }
+covariates = {}
+
+# Estimate buildings from all layers (if set, instead of population_weighting)
+# NOTE: The layers input will be a dict mapping "wp" and the name of each
+# covariate to an array of its values in all grid cells, and the function must
+# return an array of building counts (e.g. using np.where), e.g.
+# covariates_to_buildings = lambda layers: np.where(
+#     np.nan_to_num(layers["built"]) > 0, layers["wp"], 0)
+covariates_to_buildings = None
 
 
 # Loss types to aggregate from the exposure input file
@@ -90,6 +129,12 @@ loss_types = ["structural", "night"]
 # Tags to retain from the exposure input file
 retain_tags = ["taxonomy"]
 
+# Number of rows read at once from the input exposure file (None to read the
+# whole file at once) and data type of number and loss_types values (e.g.
+# "float32" to halve memory of very large files)
+exposure_chunksize = 500000
+exposure_value_dtype = "float64"
+
 # Input exposure directory
 exp_directory = os.path.join("data", "exposure_in")
 
@@ -103,9 +148,75 @@ worldpop_year = 2020
 shp_directory = os.path.join("data", "shapefile_in")
 wp_directory = os.path.join("data", "worldpop")
 
+# WorldPop downloads (see download_worldpop.py) - source of the rasters, either
+# the WorldPop server or a local mirror with the same layout (a directory or
+# file:// URL), number of concurrent downloads, size of the chunks streamed to
+# disk and number of attempts per raster (each resuming the partial download)
+worldpop_source = "https://data.worldpop.org/GIS/Population"
+download_workers = 4
+download_chunk_mb = 8
+download_retries = 3
+
 # File locations - inputs
 name = "Austria"
-shp_file = f"Adm{adm_level}_{name}.shp"
+shp_template = "Adm{adm_level}_{name}.shp"
+shp_file = shp_template.format(adm_level=adm_level, name=name)
+
+# Batch runs (see batch_script.py) - groups run for each country by default
+# and number of worker processes (None to use all available cores)
+batch_groups = ["Res", "Com"]
+batch_workers = None
+
+# Shared grids of batch runs - the grid of each country is written once to
+# shared_grid_dir as memory-mapped NumPy arrays (one file per column), which
+# the jobs of all its groups attach to without copying, such that concurrent
+# jobs share one physical copy of the grid (a RAM-backed directory, e.g.
+# /dev/shm on Linux, avoids writing the grid to disk)
+shared_grid_dir = os.path.join("data", "shared")
 
 # Directory locations - outputs
 output_dir = os.path.join("output")
+
+# Output exposure model format - "csv" (OQ exposure CSV, written in chunks of
+# csv_chunksize rows), "parquet" or "feather" (compressed with
+# output_compression); write_partitions writes the model bound by bound as it
+# is sampled, such that the full model is never held in memory
+output_format = "csv"
+output_compression = "zstd"
+csv_chunksize = 100000
+write_partitions = False
+
+# Incremental mode - store the sampled result of each admin bound, such that
+# reruns only resample bounds whose exposure or grid changed (requires a seed)
+incremental = False
+incremental_dir = os.path.join(output_dir, "bounds")
+
+# Profiling - report the wall time, CPU time, peak memory and rows of each
+# stage (and, if profile_bounds is set, of each admin bound) to profile_dir,
+# as "json" or "csv"
+profile_report = True
+profile_bounds = False
+profile_format = "json"
+profile_dir = os.path.join(output_dir, "profiles")
+
+# Progress of long loops (e.g. over admin bounds) - "bar" (a single line
+# updated in place), "log" (a line at most every progress_interval seconds)
+# or "none"
+progress_mode = "log"
+progress_interval = 5
+
+# Cache of resampled rasters; the least recently used rasters are removed once
+# the cache exceeds raster_cache_max_mb
+raster_cache_dir = os.path.join(wp_directory, "cache")
+raster_cache_max_mb = 4096
+
+# Cache of grid points associated with admin bounds, stored as "feather" or
+# "parquet"; the least recently used files are removed once the cache exceeds
+# grid_cache_max_mb
+grid_cache_dir = os.path.join("data", "cache")
+grid_cache_format = "feather"
+grid_cache_max_mb = 4096
+
+# Identify cached inputs by a hash of their full content rather than by their
+# path, size and modification time (slower, but robust to copied files)
+cache_content_hash = False
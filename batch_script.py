@@ -0,0 +1,251 @@
+# ------------------------------------------------------------------------------
+#   LOADING DEPENDENCIES AND INPUTS
+# ------------------------------------------------------------------------------
+
+import time
+import shutil
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from _config import *
+import numpy as np
+import pandas as pd
+from main_script import run_group, prepare_grid, lookup_country
+from util.geo import GridIndex
+from util.cache import write_shared_frame, read_shared_frame
+from util.profiling import Profiler
+
+
+# ------------------------------------------------------------------------------
+#   DEFINE BATCH FUNCTIONS
+# ------------------------------------------------------------------------------
+
+# Arrange list of country/group jobs from command line items
+def parse_jobs(items, groups=batch_groups, mf=None):
+    ''' This function converts a list of items into (country, iso, group)
+    jobs. Each item is either "<country>:<group>", "<country>" (for all
+    groups) or "all" (for all countries in the mosaic mapping scheme and all
+    groups), where <country> is the country name, short name or ISO code.'''
+
+    # Read in mapping scheme once
+    if mf is None:
+        mf = pd.read_csv(mosaic_mapping, encoding="utf-8", header=0)
+
+    # Arrange jobs, skipping duplicates
+    jobs = []
+    for item in items:
+        if item.lower() == "all":
+            countries, item_groups = list(mf["iso_name"]), groups
+        elif ":" in item:
+            country, group = item.split(":", 1)
+            countries, item_groups = [country], [group]
+        else:
+            countries, item_groups = [item], groups
+        for country in countries:
+            country_name, iso_name = lookup_country(country, mf)
+            for group in item_groups:
+                job = (country_name, iso_name, group.title())
+                if job not in jobs:
+                    jobs.append(job)
+
+    # Return result
+    return jobs
+
+
+# Prepare the grid of one country and share it with the jobs of its groups
+def prepare_country(country_name, iso_name, seed=seed,
+                    share_dir=shared_grid_dir):
+    ''' This function prepares the grid of a country once and writes it to
+    share_dir as memory-mapped arrays (see write_shared_frame), such that the
+    jobs of all groups of the country attach to one physical copy of the
+    grid. Returns the admin bounds, the path of the shared grid, the profiler
+    holding the stages of the grid preparation and the time it took.'''
+
+    # Prepare grid
+    tic = time.perf_counter()
+    profiler = Profiler(country=country_name, seed=seed)
+    adm, df, _ = prepare_grid(field_name, adm_level, country_name, iso_name,
+                              profiler=profiler)
+
+    # Write grid to be shared (unique to this process, as several batches
+    # may run at once)
+    grid_path = os.path.join(share_dir, f"grid_{iso_name}_{os.getpid()}")
+    with profiler.stage("share_grid") as stage:
+        write_shared_frame(df, grid_path)
+        stage["rows"] = df.shape[0]
+
+    # Return result
+    return adm, grid_path, profiler, time.perf_counter() - tic
+
+
+# Run one group of a country on its shared grid
+def run_shared_group(country_name, iso_name, group, adm, grid_path, profiler,
+                     seed=seed):
+    ''' This function attaches to the shared grid of a country (see
+    prepare_country) and runs and writes the exposure model of one group.
+    Failures are caught and reported, such that one failing job never aborts
+    the others. Returns the job report (timing, status and error message).
+    The profiling report of the group includes the stages of the shared grid
+    preparation.'''
+
+    # Run group on shared grid (sliced in place, see grid_partition)
+    tic = time.perf_counter()
+    try:
+        df = read_shared_frame(grid_path)
+        grid = (adm, df, GridIndex.from_frame(df))
+        run_group(field_name, adm_level, country_name, iso_name, group,
+                  grid=grid, seed=seed, profiler=profiler.copy(group=group))
+        status, error = "done", None
+    except Exception:
+        status, error = "failed", traceback.format_exc()
+
+    # Return report
+    return {
+        "country": country_name, "iso": iso_name, "group": group,
+        "status": status, "seconds": time.perf_counter() - tic,
+        "error": error
+        }
+
+
+# Run jobs across a pool of worker processes
+def run_batch(jobs, n_workers=batch_workers, seed=seed):
+    ''' This function schedules (country, iso, group) jobs across a pool of
+    n_workers processes. The grid of each country is prepared once (see
+    prepare_country), and the jobs of its groups are then run concurrently
+    on the shared grid (see run_shared_group), which is removed once all of
+    them finished. If a worker process dies (e.g. out of memory), the pool
+    breaks and all jobs not finished by then are reported as failed, rather
+    than aborting the batch. Returns a dataframe reporting the timing and
+    status of every job.'''
+
+    # Group jobs by country
+    countries = {}
+    for country_name, iso_name, group in jobs:
+        countries.setdefault((country_name, iso_name), []).append(group)
+
+    # Initialize list of job reports, and report of a job that failed
+    # outside run_shared_group (or was lost when the pool broke)
+    reports = []
+    lost = ("Lost when a worker process of the pool died (e.g. out of "
+            "memory), possibly while running another job\n")
+    def failed(country_name, iso_name, group, prep_time=np.nan, error=None):
+        return {
+            "country": country_name, "iso": iso_name, "group": group,
+            "status": "failed", "prepare_seconds": prep_time,
+            "seconds": np.nan, "error": error or traceback.format_exc()
+            }
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+
+        # Prepare grid of each country
+        prepared = {
+            pool.submit(prepare_country, *key, seed): key for key in countries
+            }
+
+        # Submit jobs of each group as soon as the grid of its country is
+        # shared
+        futures, grid_paths, pending = {}, {}, {}
+        for future in as_completed(prepared):
+            key = prepared[future]
+            try:
+                adm, grid_path, profiler, prep_time = future.result()
+            except BrokenProcessPool:
+                reports.extend(failed(*key, group, error=lost)
+                               for group in countries[key])
+                print_red(f"{key[0]}: grid preparation lost, a worker process died")
+                continue
+            except Exception:
+                reports.extend(failed(*key, group) for group in countries[key])
+                print_red(f"{key[0]}: grid preparation failed")
+                continue
+
+            # Submit jobs, unless the pool broke in the meantime
+            grid_paths[key], pending[key] = grid_path, len(countries[key])
+            for group in countries[key]:
+                try:
+                    futures[pool.submit(run_shared_group, *key, group, adm,
+                                        grid_path, profiler, seed)] = (
+                        key, group, prep_time
+                        )
+                except BrokenProcessPool:
+                    reports.append(failed(*key, group, prep_time, error=lost))
+                    print_red(f"{key[0]} {group}: not run, a worker process died")
+                    pending[key] -= 1
+            if pending[key] == 0:
+                shutil.rmtree(grid_path, ignore_errors=True)
+
+        # Collect reports as jobs finish
+        for future in as_completed(futures):
+            key, group, prep_time = futures[future]
+            try:
+                report = dict(future.result(), prepare_seconds=prep_time)
+            except BrokenProcessPool:
+                report = failed(*key, group, prep_time, error=lost)
+            except Exception:
+                report = failed(*key, group, prep_time)
+            if report["status"] == "done":
+                print(f"{report['country']} {report['group']}: done in {report['seconds']:0.2f} seconds")
+            else:
+                print_red(f"{report['country']} {report['group']}: failed")
+            reports.append(report)
+
+            # Remove shared grid once all groups of the country finished
+            pending[key] -= 1
+            if pending[key] == 0:
+                shutil.rmtree(grid_paths[key], ignore_errors=True)
+
+    # Return result
+    columns = ["country", "iso", "group", "status", "prepare_seconds",
+               "seconds", "error"]
+    return pd.DataFrame(reports, columns=columns)
+
+
+# ------------------------------------------------------------------------------
+#   CALLING BATCH FUNCTION
+# ------------------------------------------------------------------------------
+
+
+# Run batch if called as script
+if __name__ == "__main__":
+
+    # Time code
+    tic = time.perf_counter()
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description="Run the spatial disaggregation for many countries and "
+                    "groups in parallel."
+        )
+    parser.add_argument(
+        "items", nargs="+",
+        help='"<country>:<group>", "<country>" (all groups) or "all"'
+        )
+    parser.add_argument(
+        "--groups", nargs="+", default=batch_groups,
+        help="groups used for items without a group"
+        )
+    parser.add_argument(
+        "--workers", type=int, default=batch_workers,
+        help="number of worker processes"
+        )
+    parser.add_argument(
+        "--seed", type=int, default=seed,
+        help="seed of the random number generator used for sampling"
+        )
+    args = parser.parse_args()
+
+    # Arrange and run jobs
+    jobs = parse_jobs(args.items, args.groups)
+    report = run_batch(jobs, args.workers, args.seed)
+
+    # Write report of all jobs
+    report_path = os.path.join(output_dir, "batch_report.csv")
+    report.to_csv(report_path, index=False)
+
+    # Print summary
+    n_failed = (report["status"] != "done").sum()
+    if n_failed:
+        print_red(f"IMPORTANT WARNING: {n_failed} of {len(report)} jobs failed, see {report_path}")
+    toc = time.perf_counter()
+    print(f"Batch of {len(report)} jobs took {toc - tic:0.4f} seconds")
@@ -0,0 +1,408 @@
+# ------------------------------------------------------------------------------
+#   LOADING DEPENDENCIES AND INPUTS
+# ------------------------------------------------------------------------------
+
+import time
+import json
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime, timezone
+from _config import *
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely.geometry
+import rasterio as rio
+from rasterio import Affine
+import parsers.exposure
+import util.geo
+import util.model
+import util.profiling
+import main_script
+from parsers.exposure import parse_exposure
+from util.geo import (resample_raster_to_resolution, associate_grid_to_bounds,
+                      add_excepted_bounds, grid_field)
+from util.model import write_model
+from calcs.sampling import resample_assets, grid_partition, grid_cells
+from calcs.weighting import population_to_counts
+from util.profiling import PeakMemory
+from util.raster import AggregatedRaster
+
+
+# Sizes of synthetic inputs (pixels of the raster before resampling, admin
+# bounds, taxonomies per bound and buildings in total)
+benchmark_sizes = {
+    "small": {"pixels": 250000, "bounds": 20, "taxonomies": 20,
+              "buildings": 100000},
+    "medium": {"pixels": 4000000, "bounds": 200, "taxonomies": 100,
+               "buildings": 2000000},
+    "large": {"pixels": 25000000, "bounds": 2000, "taxonomies": 300,
+              "buildings": 20000000},
+}
+
+# Resolution of the synthetic raster (similar to 1km WorldPop) and
+# aggregation factor of the resampled raster
+benchmark_pixel_size = 0.0083333333
+benchmark_factor = 5
+
+# History of benchmark results (ignored by git, see .gitignore)
+benchmark_history = os.path.join(output_dir, "benchmark_history.json")
+
+
+# ------------------------------------------------------------------------------
+#   SYNTHETIC INPUTS
+# ------------------------------------------------------------------------------
+
+# Write synthetic population raster
+def make_raster(file_path, n_pixels, rng, pixel_size=benchmark_pixel_size):
+    ''' This function writes a square GeoTIFF of about n_pixels pixels with
+    lognormal population estimates (similar to WorldPop), including a band
+    of nodata values along one edge. Returns the raster bounds.'''
+
+    # Arrange dimensions and transform
+    width = height = max(int(np.sqrt(n_pixels)), benchmark_factor)
+    x0, y0 = 10.0, 50.0
+    transform = Affine(pixel_size, 0, x0, 0, -pixel_size, y0)
+
+    # Generate population estimates with nodata band
+    no_data = -99999.0
+    data = rng.lognormal(0.0, 1.5, size=(height, width)).astype(np.float32)
+    data[:, :max(width // 50, 1)] = no_data
+
+    # Write raster
+    with rio.open(file_path, "w", driver="GTiff", height=height, width=width,
+                  count=1, dtype="float32", crs=desired_crs,
+                  transform=transform, nodata=no_data, tiled=True) as dst:
+        dst.write(data, 1)
+
+    # Return bounds
+    return x0, y0 - height * pixel_size, x0 + width * pixel_size, y0
+
+
+# Arrange synthetic admin bounds
+def make_bounds(n_bounds, raster_bounds, mapped_field):
+    ''' This function splits the raster extent into a regular grid of
+    n_bounds rectangular admin bounds, and adds a few tiny bounds (smaller
+    than a resampled pixel) such that add_excepted_bounds is exercised.'''
+
+    # Arrange grid of bounds
+    left, bottom, right, top = raster_bounds
+    nx = int(np.ceil(np.sqrt(n_bounds)))
+    ny = int(np.ceil(n_bounds / nx))
+    dx, dy = (right - left) / nx, (top - bottom) / ny
+    geoms = [
+        shapely.geometry.box(left + i * dx, top - (j + 1) * dy,
+                             left + (i + 1) * dx, top - j * dy)
+        for j in range(ny) for i in range(nx)
+        ][:n_bounds]
+
+    # Add tiny bounds
+    size = benchmark_pixel_size / 10
+    geoms += [
+        shapely.geometry.box(left + (i + 0.5) * dx, top - 0.5 * dy,
+                             left + (i + 0.5) * dx + size, top - 0.5 * dy + size)
+        for i in range(max(n_bounds // 20, 1))
+        ]
+
+    # Arrange GeoDataFrame
+    names = [f"SYN.{i + 1}_1" for i in range(len(geoms))]
+    adm = gpd.GeoDataFrame({mapped_field: names, "NAME_1": names},
+                           geometry=geoms, crs=desired_crs)
+
+    # Return result
+    return adm
+
+
+# Write synthetic exposure CSV
+def make_exposure(file_path, adm, mapped_field, n_taxonomies, n_buildings,
+                  rng):
+    ''' This function writes an exposure CSV in the input layout, with
+    n_taxonomies classes in every admin bound and n_buildings (fractional)
+    buildings distributed randomly across bounds and classes.'''
+
+    # Arrange one row per bound and taxonomy
+    bound_names = adm[mapped_field].to_numpy()
+    taxonomies = np.array([f"SYN/TAX+{t}/H:{t % 5 + 1}"
+                           for t in range(n_taxonomies)])
+    n_rows = len(bound_names) * n_taxonomies
+
+    # Distribute buildings and values
+    number = rng.dirichlet(np.ones(n_rows)) * n_buildings
+    exposure = pd.DataFrame({
+        "id": [f"Syn_{i}" for i in range(n_rows)],
+        "lon": 0.0,
+        "lat": 0.0,
+        "taxonomy": np.tile(taxonomies, len(bound_names)),
+        "number": number,
+        "structural": number * rng.uniform(5e4, 5e5, n_rows),
+        "night": number * rng.uniform(0, 5, n_rows),
+        "occupancy": "Syn",
+        mapped_field.lower(): np.repeat(bound_names, n_taxonomies),
+        })
+
+    # Write file
+    exposure.to_csv(file_path, index=False)
+
+
+# ------------------------------------------------------------------------------
+#   MEASUREMENT
+# ------------------------------------------------------------------------------
+
+# Measure wall time and peak memory of one stage
+def measure(results, stage, func, *args, **kwargs):
+    ''' This function calls func, recording in results[stage] its wall time,
+    the peak RSS of the process while it ran and the increase of RSS over
+    the start of the stage. Errors are recorded rather than raised. Returns
+    the result of func.'''
+
+    # Call function while tracking memory
+    with PeakMemory() as memory:
+        tic = time.perf_counter()
+        try:
+            out, error = func(*args, **kwargs), None
+        except Exception as e:
+            out, error = None, f"{type(e).__name__}: {e}"
+        toc = time.perf_counter()
+
+    # Record result
+    results[stage] = {
+        "seconds": toc - tic,
+        "peak_mb": memory.peak_mb,
+        "delta_mb": memory.delta_mb,
+        "error": error,
+        }
+    memory_text = ""
+    if memory.peak_mb is not None:
+        memory_text = f", peak {memory.peak_mb:0.1f} MB"
+    if memory.delta_mb is not None:
+        memory_text += f" (+{memory.delta_mb:0.1f} MB)"
+    print(f"{stage}: {toc - tic:0.4f} seconds{memory_text}"
+          + (f" ({error})" if error else ""))
+
+    # Return result
+    return out
+
+
+# Resample raster and aggregate it right away (if aggregated in memory)
+def load_raster(wp_path, wp_name, new_res):
+    resampled = resample_raster_to_resolution(wp_path, wp_name, new_res)
+    if isinstance(resampled, AggregatedRaster):
+        resampled.load()
+    return resampled
+
+
+# Override module level settings within a with block
+@contextlib.contextmanager
+def overridden(module, **values):
+    ''' This function sets module level settings (e.g. directories taken from
+    _config.py) of module to the given values, and restores the previous
+    values once the with block exits, even if it raised.'''
+    previous = {name: getattr(module, name) for name in values}
+    try:
+        for name, value in values.items():
+            setattr(module, name, value)
+        yield module
+    finally:
+        for name, value in previous.items():
+            setattr(module, name, value)
+
+
+# Run the whole pipeline on the synthetic inputs
+def run_pipeline(tmp_dir, new_res, mapped_field, seed=seed):
+    ''' This function runs run_group (see main_script.py) on the synthetic
+    inputs in tmp_dir as a normal run would (including caches, bounds without
+    grid points and the model writer), with outputs and caches redirected to
+    tmp_dir. Returns the path of the written model.'''
+
+    # Redirect inputs, outputs and caches of the pipeline to tmp_dir (the
+    # resolution also keys the grid cache)
+    with overridden(main_script, wp_directory=tmp_dir, shp_directory=tmp_dir,
+                    res=new_res,
+                    incremental_dir=os.path.join(tmp_dir, "bounds")), \
+         overridden(util.geo, res=new_res,
+                    grid_cache_dir=os.path.join(tmp_dir, "cache")), \
+         overridden(util.profiling,
+                    profile_dir=os.path.join(tmp_dir, "profiles")):
+
+        # Run pipeline for synthetic country and group
+        return main_script.run_group(mapped_field, 1, "Synthetic", "SYN",
+                                     "Syn", seed=seed)
+
+
+# Run all stages on synthetic inputs of one size
+def run_benchmark(size, seed=seed):
+    ''' This function generates synthetic inputs of the given size (see
+    benchmark_sizes), runs each stage of the disaggregation individually and
+    in sequence, then the whole pipeline as one run (see run_pipeline), and
+    returns the results of each stage, their total and the end-to-end
+    run.'''
+
+    # Arrange inputs in temporary directory
+    rng = np.random.default_rng(seed)
+    results = {}
+    mapped_field = field_name
+    with contextlib.ExitStack() as stack:
+        tmp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+
+        # Redirect input, output and cache directories to tmp_dir (models are
+        # written to a subdirectory, such that the exposure input is kept),
+        # restoring them on exit
+        stack.enter_context(overridden(parsers.exposure,
+                                       exp_directory=tmp_dir))
+        stack.enter_context(overridden(
+            util.model, output_dir=os.path.join(tmp_dir, "output")
+            ))
+        stack.enter_context(overridden(
+            util.geo, raster_cache_dir=os.path.join(tmp_dir, "cache")
+            ))
+        os.makedirs(util.model.output_dir)
+
+        # Generate synthetic inputs
+        wp_name = f"syn_ppp_{worldpop_year}.tif"
+        wp_path = os.path.join(tmp_dir, wp_name)
+        raster_bounds = make_raster(wp_path, size["pixels"], rng)
+        adm = make_bounds(size["bounds"], raster_bounds, mapped_field)
+        adm.to_file(os.path.join(
+            tmp_dir, shp_template.format(adm_level=1, name="Synthetic")
+            ))
+        make_exposure(os.path.join(tmp_dir, "Exposure_Syn_Synthetic.csv"),
+                      adm, mapped_field, size["taxonomies"],
+                      size["buildings"], rng)
+
+        # Resample raster (aggregating in memory right away, see
+        # AggregatedRaster)
+        tic = time.perf_counter()
+        new_res = benchmark_pixel_size * benchmark_factor
+        resampled = measure(results, "resample_raster_to_resolution",
+                            load_raster, wp_path, wp_name, new_res)
+        if resampled is None:
+            resampled = wp_path  # e.g. GDAL unavailable
+
+        # Associate grid to bounds
+        grid = measure(results, "associate_grid_to_bounds",
+                       associate_grid_to_bounds, resampled, adm, mapped_field,
+                       value_name="wp", with_geometry=False)
+        df, _ = grid
+        df["count"] = population_to_counts(df["wp"].to_numpy())
+        results["associate_grid_to_bounds"]["rows"] = df.shape[0]
+
+        # Parse exposure
+        assets, distinct_field = measure(results, "parse_exposure",
+                                         parse_exposure, "Synthetic", "Syn",
+                                         mapped_field)
+        results["parse_exposure"]["rows"] = assets.shape[0]
+
+        # Add bounds without grid points
+        exceptions = list(np.setdiff1d(distinct_field,
+                                       grid_field(df, adm, mapped_field)))
+        df_all = measure(results, "add_excepted_bounds", add_excepted_bounds,
+                         df, adm, exceptions, mapped_field)
+        if df_all is None:
+            df_all = df
+        results["add_excepted_bounds"]["rows"] = len(exceptions)
+
+        # Sample assets
+        cells = grid_cells(df_all, grid_partition(
+            df_all["adm_code"].to_numpy(), adm[mapped_field].to_numpy()
+            ))
+        model = measure(results, "resample_assets", resample_assets, df_all,
+                        assets, np.asarray(list(cells)), mapped_field,
+                        seed=seed, cells=cells)
+        results["resample_assets"]["rows"] = model.shape[0]
+
+        # Write model
+        model = model.rename(columns={"x": "lon", "y": "lat"})
+        measure(results, "write_model", write_model, model,
+                "Exposure_Syn_Synthetic.csv", "Syn")
+
+        # Record total of the stages above
+        results["stages_total"] = {
+            "seconds": time.perf_counter() - tic,
+            "peak_mb": max((r["peak_mb"] for r in results.values()
+                            if r["peak_mb"] is not None), default=None),
+            "delta_mb": max((r["delta_mb"] for r in results.values()
+                             if r["delta_mb"] is not None), default=None),
+            "error": None,
+            }
+
+        # Run whole pipeline as one run (the raster is resampled again, as
+        # only the "gdal" engine caches it, and the grid cache starts empty)
+        measure(results, "end_to_end", run_pipeline, tmp_dir, new_res,
+                mapped_field, seed=seed)
+
+    # Return result
+    return results
+
+
+# Append results to the benchmark history
+def append_history(entry, history_path=benchmark_history):
+    ''' This function appends one benchmark entry to the JSON history file,
+    such that regressions can be tracked across commits.'''
+
+    # Read existing history
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path, encoding="utf-8") as f:
+            history = json.load(f)
+
+    # Write updated history
+    history.append(entry)
+    with open(history_path, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=2)
+
+
+# Get current git commit, if available
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+# ------------------------------------------------------------------------------
+#   CALLING BENCHMARK FUNCTION
+# ------------------------------------------------------------------------------
+
+
+# Run benchmarks if called as script
+if __name__ == "__main__":
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the spatial disaggregation on "
+                    "synthetic inputs."
+        )
+    parser.add_argument("sizes", nargs="*", default=["small"],
+                        help=f"preset sizes, among {list(benchmark_sizes)}")
+    parser.add_argument("--pixels", type=int, help="override raster pixels")
+    parser.add_argument("--bounds", type=int, help="override admin bounds")
+    parser.add_argument("--taxonomies", type=int,
+                        help="override taxonomies per bound")
+    parser.add_argument("--buildings", type=int, help="override buildings")
+    parser.add_argument("--history", default=benchmark_history,
+                        help="JSON file to which results are appended")
+    args = parser.parse_args()
+
+    # Run each requested size
+    for name in args.sizes:
+        size = dict(benchmark_sizes[name])
+        for key in size:
+            if getattr(args, key) is not None:
+                size[key] = getattr(args, key)
+        print(f"\nBenchmark '{name}': {size}")
+        results = run_benchmark(size)
+
+        # Record results in history
+        append_history({
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "size": name,
+            "parameters": size,
+            "results": results,
+            }, args.history)
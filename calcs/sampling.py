@@ -1,95 +1,474 @@
 # Load dependencies
 from _config import *
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import time
+from util.cache import array_fingerprint, cache_key, write_frame, read_frame
+from util.profiling import Progress
+
+
+# Convert any value (e.g. a bound name or taxonomy) to a stable integer key
+def stream_key(value):
+    ''' This function hashes the string representation of a value into a
+    64-bit integer, which (unlike the built-in hash) is identical across
+    processes and runs. It is used to identify random number streams.'''
+    digest = hashlib.sha256(str(value).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+# Combine a base seed with names (e.g. country and group) into a new seed
+def derive_seed(seed, *names):
+    ''' This function returns the entropy used to seed all random number
+    streams of one run, derived from the base seed and the given names such
+    that different groups never share streams. If seed is None, None is
+    returned and fresh entropy is drawn when sampling (i.e. results differ
+    between runs).'''
+    if seed is None:
+        return None
+    return [seed] + [stream_key(name) for name in names]
+
+
+# Draw the grid cells of the buildings of one class
+def draw_cells(rng, n_samples, w_last, p, cdf):
+    ''' This function draws the locations (grid cell indices) of n_samples
+    buildings with cell probabilities p (and cumulative probabilities cdf),
+    where the last building has weight w_last and all others weight 1. It
+    returns the distinct cells drawn and their summed weights. Multinomial
+    counts are drawn if there are fewer cells than buildings; otherwise the
+    location of each building is drawn directly.'''
+
+    # Get number of cells
+    n_cells = p.shape[0]
+
+    # Draw counts of full-weight buildings per cell at once
+    if n_cells <= n_samples:
+        weights = rng.multinomial(n_samples - 1, p).astype(np.float64)
+        i_last = np.searchsorted(cdf, rng.random(), side="right")
+        weights[min(i_last, n_cells - 1)] += w_last
+        i = np.flatnonzero(weights)
+        w = weights[i]
+
+    # Otherwise draw location of each building and aggregate
+    else:
+        i_all = np.searchsorted(cdf, rng.random(n_samples), side="right")
+        i_all = np.minimum(i_all, n_cells - 1)
+        w_all = np.ones((n_samples,))
+        w_all[-1] = w_last
+        i, inverse = np.unique(i_all, return_inverse=True)
+        w = np.bincount(inverse.ravel(), weights=w_all)
+
+    # Return result
+    return i, w
+
+
+# Allocate assets of one admin bound to its grid cells
+def allocate_bound(p, values, rngs):
+    ''' This function distributes all classes (e.g. taxonomies) of a single
+    admin bound across the grid cells of that bound. The cell probabilities
+    are given by p and values holds one row per class, with the number of
+    buildings in the first column followed by the loss_types. The buildings
+    of each class are drawn with that class's own random number generator
+    (from rngs), and only the aggregated (class, cell) pairs are returned
+    together with their allocated values, such that no row per building is
+    ever materialised. As before, the last building of a class with a
+    fractional number of buildings is given a reduced weight.'''
+
+    # Get number of samples desired per class (ignore empty classes)
+    number = values[:, 0]
+    n_samples = np.ceil(np.maximum(number, 0)).astype(np.int64)
+
+    # Get weights of the last sample of each class
+    w_last = np.where(n_samples != number, n_samples - number, 1.0)
+
+    # Cumulative probabilities used for drawing individual locations
+    cdf = np.cumsum(p)
+    cdf /= cdf[-1]
+
+    # Draw locations class by class
+    k, i, w = [], [], []
+    for c in np.flatnonzero(n_samples > 0):
+        i_c, w_c = draw_cells(rngs[c], n_samples[c], w_last[c], p, cdf)
+        k.append(np.full(i_c.shape, c))
+        i.append(i_c)
+        w.append(w_c / (n_samples[c] - 1 + w_last[c]))  # normalize weights
+    if not k:
+        return (np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64),
+                np.zeros((0, values.shape[1])))
+    k, i, w = np.concatenate(k), np.concatenate(i), np.concatenate(w)
+
+    # Add number and loss type values according to weight
+    allocated = values[k] * w[:, np.newaxis]
+
+    return k, i, allocated
+
+
+# Allocate assets of one admin bound to its grid cells in closed form
+def allocate_exact(p, values):
+    ''' This function distributes all classes (e.g. taxonomies) of a single
+    admin bound across the grid cells of that bound without random draws,
+    taking the same inputs and returning the same (class, cell) pairs and
+    allocated values as allocate_bound. The whole buildings of each class
+    are split in proportion to p, rounding down and then giving one more
+    building to the cells with the largest remainders (ties going to cells
+    with larger p, then to earlier cells), and any fractional building is
+    added to the next cell in that order. Totals are therefore preserved
+    exactly, at a cost proportional to the number of cells and classes.'''
+
+    # Get whole and fractional number of buildings per class
+    number = values[:, 0]
+    whole = np.floor(np.maximum(number, 0))
+
+    # Allocate class by class
+    k, i, n = [], [], []
+    for c in np.flatnonzero(number > 0):
+
+        # Split whole buildings proportionally, rounding down
+        quota = whole[c] * p
+        n_c = np.floor(quota)
+        remainder = quota - n_c
+
+        # Give remaining whole buildings to cells with largest remainders,
+        # followed by the fractional building
+        order = np.lexsort((-p, -remainder))
+        n_left = int(round(whole[c] - n_c.sum()))
+        n_c[order[:n_left]] += 1
+        n_c[order[n_left]] += number[c] - whole[c]
+
+        # Keep cells with buildings
+        i_c = np.flatnonzero(n_c)
+        k.append(np.full(i_c.shape, c))
+        i.append(i_c)
+        n.append(n_c[i_c])
+    if not k:
+        return (np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64),
+                np.zeros((0, values.shape[1])))
+    k, i, n = np.concatenate(k), np.concatenate(i), np.concatenate(n)
+
+    # Add loss type values in proportion to the number of buildings
+    allocated = values[k] * (n / number[k])[:, np.newaxis]
+    allocated[:, 0] = n
+
+    return k, i, allocated
+
+
+# Sample one admin bound with its own random number streams
+def sample_bound(count, values, seed, allocation=allocation):
+    ''' This function allocates the assets of a single admin bound to its
+    grid cells, with probabilities proportional to count (see
+    allocate_bound), and returns the aggregated (class, cell) pairs with
+    their allocated values. One random number stream is spawned
+    per class from the seed (run entropy, bound key and class keys), such
+    that results do not depend on which process samples which bound.'''
+
+    # Normalize count to get probabilities (uniform if all zero)
+    if count.sum() > 0:
+        p = count / count.sum()
+    else:
+        p = np.full(count.shape, 1 / count.shape[0])
+
+    # Allocate without random draws if requested
+    if allocation == "exact":
+        k, i, allocated = allocate_exact(p, values)
+
+    # Allocate with random number generator of each class of this bound
+    else:
+        entropy, bound_key, class_keys = seed
+        rngs = [
+            np.random.default_rng(np.random.SeedSequence(
+                entropy, spawn_key=(bound_key, class_key)
+                ))
+            for class_key in class_keys
+            ]
+        k, i, allocated = allocate_bound(p, values, rngs)
+
+    # Return result
+    return k, i, allocated
+
+
+# Sample one admin bound and time it
+def timed_sample_bound(count, values, seed, allocation=allocation):
+    ''' This function calls sample_bound and returns its result along with
+    the wall time it took (measured where it ran, e.g. in a worker).'''
+    tic = time.perf_counter()
+    result = sample_bound(count, values, seed, allocation)
+    return result, time.perf_counter() - tic
+
+
+# Partition rows of a table into contiguous groups
+def partition_index(keys):
+    ''' This function computes a one-time partition of rows by their key (e.g.
+    the mapped_field column). It returns the order that sorts rows by key
+    (stable, such that rows keep their order within a group) and a dict
+    mapping each key to the (start, end) offsets of its group in that order,
+    such that the rows of any group can be retrieved as a contiguous slice.
+    Rows with a missing key are placed first and not assigned to any group.'''
+
+    # Encode keys as integer codes
+    codes, uniques = pd.factorize(keys)
+
+    # Sort rows by code
+    order = np.argsort(codes, kind="stable")
+
+    # Get offsets of each group (after rows with missing keys)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    ends = np.cumsum(counts) + np.count_nonzero(codes < 0)
+    starts = ends - counts
+
+    # Return result
+    return order, dict(zip(uniques, zip(starts, ends)))
+
+
+# Arrange allocated (class, cell) pairs of one bound into a dataframe
+def arrange_samples(x, y, tags, k, i, allocated):
+    ''' This function arranges the result of sample_bound into a dataframe
+    with the location (x, y) of each grid cell, the retain_tags of each class
+    and the allocated number and loss_types values, ordered by location and
+    retain_tags.'''
+
+    # Order pairs by location of their cell, ranking cells once (classes are
+    # already ordered by tags)
+    rank = np.empty(x.shape[0], dtype=np.int64)
+    rank[np.lexsort((y, x))] = np.arange(x.shape[0])
+    order = np.lexsort((k, rank[i]))
+    k, i = k[order], i[order]
+
+    # Arrange into dataframe format
+    samples = tags[k].to_frame(index=False)
+    samples.insert(0, "x", x[i])
+    samples.insert(1, "y", y[i])
+    samples[["number"] + loss_types] = allocated[order]
+
+    # Return result
+    return samples
+
+
+# Partition grid points by admin bound, without copying where possible
+def grid_partition(adm_code, names):
+    ''' This function partitions grid points by the name of their admin bound
+    (names holds the name of each admin bound, indexed by adm_code), in the
+    same form as partition_index. Grids ordered by adm_code (as returned by
+    associate_grid_to_bounds) are partitioned in place, such that the order
+    is None and no per-point array is created; other grids are sorted.'''
+
+    # Get offsets of each admin bound directly if already ordered
+    names = np.asarray(names)
+    if pd.Index(names).is_unique and not np.any(adm_code[1:] < adm_code[:-1]):
+        bounds = np.arange(names.shape[0])
+        starts = np.searchsorted(adm_code, bounds, side="left")
+        ends = np.searchsorted(adm_code, bounds, side="right")
+        return None, {
+            names[b]: (starts[b], ends[b]) for b in np.flatnonzero(ends > starts)
+            }
+
+    # Otherwise sort grid points by name
+    return partition_index(names[adm_code])
+
+
+# Get grid cells of each admin bound
+def grid_cells(df, partition):
+    ''' This function returns a dict mapping the name of each admin bound to
+    the x, y and count arrays of its grid cells, given the partition of df
+    (see grid_partition or partition_index). These are slices of the columns
+    of df (e.g. memory-mapped, see read_shared_frame) unless the partition
+    requires sorting them.'''
+
+    # Get columns, sorted if needed
+    order, groups = partition
+    columns = [df["x"].to_numpy(), df["y"].to_numpy(),
+               df["count"].to_numpy(dtype=np.float64)]
+    if order is not None:
+        columns = [col[order] for col in columns]
+
+    # Return slices of each admin bound
+    return {
+        name: tuple(col[start:end] for col in columns)
+        for name, (start, end) in groups.items()
+        }
+
+
+# Arrange path of the stored result of one bound
+def bound_store_path(store_dir, bound_name):
+    return os.path.join(store_dir, f"bound_{stream_key(bound_name):016x}.feather")
+
+
+# Load stored results of bounds whose inputs are unchanged
+def load_stored_bounds(store_dir, bound_inputs, seeds, allocation=allocation):
+    ''' This function loads the stored result of each bound whose inputs
+    (grid cells, assets, random number streams and allocation) match the
+    stored fingerprint, and removes results of bounds no longer present.
+    Returns the loaded results (None where the bound must be resampled) and
+    the fingerprints.'''
+
+    # Initialize store
+    os.makedirs(store_dir, exist_ok=True)
+    stored, fingerprints, paths = [], [], set()
+
+    # Compare fingerprint of each bound with stored fingerprint
+    for inputs, seed_b in zip(bound_inputs, seeds):
+        fingerprint = cache_key(array_fingerprint(*inputs[1:5]), seed_b,
+                                allocation)
+        path = bound_store_path(store_dir, inputs[0])
+        frame = None
+        if os.path.exists(path):
+            frame, metadata = read_frame(path, "feather")
+            if metadata.get("fingerprint") != fingerprint:
+                frame = None
+        stored.append(frame)
+        fingerprints.append(fingerprint)
+        paths.add(os.path.abspath(path))
+
+    # Remove results of bounds that are no longer present
+    for entry in os.scandir(store_dir):
+        if entry.name.startswith("bound_") and \
+                os.path.abspath(entry.path) not in paths:
+            os.remove(entry.path)
+
+    # Return result
+    return stored, fingerprints
 
 
 # Resample assets based on additional data (e.g. WorldPop)
-def resample_assets(df, assets, bound_names, mapped_field):
-    ''' This function takes the input exposure CSV and resamples for each
-    bound_name in the mapped_field using the additional data (e.g. WorldPop)
-    at the desired resolution (res) specified in _config.py'''
+def resample_assets(df, assets, bound_names, mapped_field,
+                    n_jobs=sampling_workers, seed=seed, store_dir=None,
+                    on_bound=None, profiler=None, cells=None,
+                    allocation=allocation):
+    ''' This function takes the input exposure and allocates the assets of
+    each bound_name to its grid cells in df (with probabilities proportional
+    to count, see sample_bound), bound by bound across n_jobs processes. See
+    load_stored_bounds for store_dir, and on_bound is called with the result
+    of each bound instead of concatenating them (e.g. to write it). The grid
+    cells of each bound can be given as cells (see grid_cells).'''
 
     # Retain specific columns
     retain_cols = ["x", "y", "number"] + retain_tags + loss_types
+    value_cols = ["number"] + loss_types
 
     # Determine number of bound_names
     n_bounds = len(bound_names)
 
-    # Initialize empty dataframe to store sample locations
-    samples = pd.DataFrame(columns=retain_cols)
+    # Partition grid by mapped_field once (unless given)
+    if cells is None:
+        cells = grid_cells(df, partition_index(df[mapped_field].to_numpy()))
+
+    # Pivot all assets by mapped_field, retain_tags and loss_types at once;
+    # result is sorted by mapped_field, so each bound is a contiguous slice
+    asset_pivot = assets.pivot_table(
+        index=[mapped_field] + retain_tags,
+        values=value_cols,
+        aggfunc="sum",
+        observed=True
+    )
+    _, asset_groups = partition_index(
+        asset_pivot.index.get_level_values(0).to_numpy()
+        )
+    asset_values = asset_pivot[value_cols].to_numpy(np.float64)
+    asset_tags = asset_pivot.index.droplevel(0)
 
-    # Initialize dataframes for each bound_name
-    bound_samples = [pd.DataFrame(columns=df.columns) for i in range(n_bounds)]
+    # Initialize list to store arrays of each bound_name to be sampled
+    bound_inputs = []
 
     # For each admin bound
     for j in range(n_bounds):
 
         # Get bound name
         bound_name = bound_names[j]
-        print(bound_name)
 
-        # Grab relevant assets from input exposure
-        idx = (assets[mapped_field] == bound_name)
-
-        # Get relevant locations from df grid
-        jdx = df[mapped_field] == bound_name
-        df_jdx = df[jdx]
+        # Grab relevant assets from input exposure and grid cells
+        a_start, a_end = asset_groups.get(bound_name, (0, 0))
+        x, y, count = cells.get(bound_name, ((), (), ()))
 
         # Sample only if not empty; pass otherewise (e.g. water bodies)
-        if assets[idx].shape[0] > 0:
-
-            # Retrieve indices
-            i_jdx = df_jdx.index.values
+        if a_end > a_start and len(count) > 0:
 
-            # Normalize count to get probabilities
-            p_jdx = df_jdx['count'] / df_jdx['count'].sum()
+            # Keep arrays needed for sampling and arranging results
+            bound_inputs.append((
+                bound_name, x, y, count, asset_values[a_start:a_end],
+                asset_tags[a_start:a_end]
+                ))
 
-            # Pivot by retain_tags and loss_types
-            asset_idx_pivot = assets[idx].pivot_table(
-                index=retain_tags,
-                values=["number"] + loss_types,
-                aggfunc="sum"
-            )
+        else:
 
-            # Iterate through each class and append to samples
-            for i, row in asset_idx_pivot.iterrows():
+            pass
 
-                # Get number of samples desired
-                n_samples = math.ceil(row["number"])
+    # Identify random number streams of each bound and class
+    entropy = np.random.SeedSequence(seed).entropy
+    seeds = [
+        (entropy, stream_key(inputs[0]), [stream_key(t) for t in inputs[5]])
+        for inputs in bound_inputs
+        ]
 
-                # Get weights of each sample
-                w_samples = np.ones((n_samples,))
-                if n_samples != row["number"]:
-                    w_samples[-1] = n_samples - row["number"]
+    # Reuse stored results of bounds whose inputs did not change
+    stored = [None for _ in bound_inputs]
+    fingerprints = [None for _ in bound_inputs]
+    if store_dir is not None:
+        stored, fingerprints = load_stored_bounds(store_dir, bound_inputs,
+                                                  seeds, allocation)
+    todo = [b for b in range(len(bound_inputs)) if stored[b] is None]
 
-                # Sample locations on df grid
-                sampled_jdx = random.choices(i_jdx, weights=p_jdx, k=n_samples)
+    # Allocate all classes to grid cells, bound by bound (results are
+    # consumed in order, as they become available)
+    count_all = [bound_inputs[b][3] for b in todo]
+    values_all = [bound_inputs[b][4] for b in todo]
+    seeds_todo = [seeds[b] for b in todo]
+    modes = [allocation for _ in todo]
+    pool = None
+    if n_jobs > 1 and len(todo) > 1:
+        chunksize = max(1, len(todo) // (4 * n_jobs))
+        pool = ProcessPoolExecutor(max_workers=n_jobs)
+        results = pool.map(timed_sample_bound, count_all, values_all,
+                           seeds_todo, modes, chunksize=chunksize)
+    else:
+        results = map(timed_sample_bound, count_all, values_all, seeds_todo,
+                      modes)
+    results = iter(results)
 
-                # Arrange into dataframe format
-                new_samples = df_jdx.loc[sampled_jdx].copy()
-                new_samples["weights"] = w_samples
-                new_samples["taxonomy"] = i  # FIXME: should be automatic from retain_tags
+    # Arrange results of each bound
+    bound_samples = []
+    progress = Progress(len(bound_inputs), "Sampled bounds")
+    try:
+        for b, (bound_name, x, y, _, _, tags) in enumerate(bound_inputs):
 
-                # Add number and loss type values according to weight
-                for col in ["number"] + loss_types:
-                    new_samples[col] = row[col] * new_samples["weights"] / new_samples["weights"].sum()
+            # Arrange resampled bounds into dataframe format
+            new_samples, stored[b] = stored[b], None
+            reused, seconds = new_samples is not None, 0.0
+            if not reused:
+                (k, i, allocated), seconds = next(results)
+                tic = time.perf_counter()
+                new_samples = arrange_samples(x, y, tags, k, i, allocated)
+                new_samples[mapped_field] = bound_name
 
-                # Arranged sampled indices into desired dataframe format
-                bound_samples[j] = pd.concat([bound_samples[j], new_samples],
-                                             axis=0, ignore_index=True)
+                # Store result for future runs
+                if store_dir is not None:
+                    write_frame(new_samples,
+                                bound_store_path(store_dir, bound_name),
+                                {"fingerprint": fingerprints[b]}, "feather")
+                seconds += time.perf_counter() - tic
 
-            # Aggregate samples with same location/taxonomy; assign bound_name
-            bound_samples[j] = bound_samples[j][retain_cols].groupby(
-                ["x", "y"] + retain_tags
-                ).agg(
-                    "sum"
-                ).reset_index()
-            bound_samples[j][mapped_field] = bound_name
+            # Report progress and time of bound
+            progress.update(item=bound_name)
+            if profiler is not None:
+                profiler.bound(bound_name, seconds, new_samples.shape[0],
+                               reused)
 
-        else:
+            # Pass on finished bound, or keep for concatenation
+            if on_bound is not None:
+                on_bound(new_samples)
+            else:
+                bound_samples.append(new_samples)
+    finally:
+        progress.close()
+        if pool is not None:
+            pool.shutdown()
 
-            pass
+    # Print number of reused bounds
+    if store_dir is not None:
+        print(f"Reused {len(bound_inputs) - len(todo)} of {len(bound_inputs)} bounds from {store_dir}")
 
     # Concatenate to overall samples
+    if not bound_samples:
+        return pd.DataFrame(columns=retain_cols + [mapped_field])
     samples = pd.concat(bound_samples, axis=0, ignore_index=True)
 
     # Return result
@@ -0,0 +1,62 @@
+# Load dependencies
+from _config import *
+import numpy as np
+
+
+# Proportional to population above a minimum threshold
+def threshold(pop, thresh=pop_thresh):
+    ''' This function returns the population estimates where they exceed
+    thresh, and 0 elsewhere.'''
+    return np.where(pop > thresh, pop, 0.0)
+
+
+# Proportional to population
+def linear(pop, scale=1.0):
+    ''' This function returns the population estimates multiplied by scale.'''
+    return np.multiply(pop, scale, dtype=np.float64)
+
+
+# Proportional to square root of population above a minimum threshold
+def sqrt(pop, thresh=pop_thresh):
+    ''' This function returns the square root of the population estimates
+    where they exceed thresh, and 0 elsewhere.'''
+    weights = threshold(pop, thresh)
+    return np.sqrt(weights, out=weights)
+
+
+# Proportional to population to a power above a minimum threshold
+def power(pop, exponent=pop_exponent, thresh=pop_thresh):
+    ''' This function returns the population estimates to the power exponent
+    where they exceed thresh, and 0 elsewhere.'''
+    weights = threshold(pop, thresh)
+    return np.power(weights, exponent, out=weights)
+
+
+# Available weighting functions by name
+weighting_functions = {
+    "threshold": threshold,
+    "linear": linear,
+    "sqrt": sqrt,
+    "power": power,
+}
+
+
+# Estimate building counts from population estimates
+def population_to_counts(pop, method=population_weighting,
+                         func=population_to_buildings):
+    ''' This function estimates the (relative) building count of each grid
+    cell from its population estimate, using the custom function func if
+    given (see population_to_buildings) or else the weighting function
+    method. The population estimates (e.g. a dataframe column) are passed as
+    a NumPy array, and an array of the same length is returned.'''
+
+    # Get underlying array (without copying where possible)
+    pop = np.asarray(pop, dtype=np.float64)
+
+    # Apply weighting function
+    if func is None:
+        func = weighting_functions[method]
+    counts = np.asarray(func(pop), dtype=np.float64)
+
+    # Return result
+    return counts
@@ -1,48 +1,273 @@
 # Load dependencies
 from _config import *
+import io
+import time
+import argparse
+import traceback
+import urllib.parse
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from util.cache import file_fingerprint
 
 
-# Parse function with grid; FIXME: Support other resolutions from WP beyond 1km
-def download_worldpop(iso, year=2020, res="1km"):
-    ''' This function downloads a raster file of population estimates from
-    WorldPop. At the moment, this will download the 2020 population estimate
-    at a 1km resolution for the desired country. This can be later expanded to
-    download the 100m dataset, or (where possible) a direct estimate of the
-    number of buildings.'''
+# Resolutions of WorldPop population estimates that can be downloaded
+worldpop_resolutions = ["1km", "100m"]
+
+
+# Arrange location of a raster relative to the WorldPop source
+def worldpop_path(iso, year=worldpop_year, res="1km"):
+    ''' This function returns the path of the population raster of a country
+    relative to the WorldPop source (or a mirror with the same layout), for
+    the UN adjusted 1km or (if requested) 100m dataset.'''
 
-    # Arrange url; defeault  - 1km, UN adj
-    url = f'ftp://ftp.worldpop.org.uk/GIS/Population/Global_2000_2020_1km_UNadj/{year}/{iso.upper()}/{iso.lower()}_ppp_2020_1km_Aggregated_UNadj.tif'
+    # Arrange path; default - 1km, UN adj
+    path = f"Global_2000_2020_1km_UNadj/{year}/{iso.upper()}/{iso.lower()}_ppp_{year}_1km_Aggregated_UNadj.tif"
     if res == "100m":
         # If requested, use 100m, UN adj
-        url = f'ftp://ftp.worldpop.org.uk/GIS/Population/Global_2000_2020/{year}/{iso.upper()}/{iso.lower()}_ppp_{year}_UNadj.tif'
+        path = f"Global_2000_2020/{year}/{iso.upper()}/{iso.lower()}_ppp_{year}_UNadj.tif"
 
-    # Submit request
-    r = urllib.request.urlopen(url)
+    # Return result
+    return path
 
-    # Arrange desired name
-    wp_name = f"{iso.lower()}_ppp_{year}.tif"
 
-    # Find relevant file
+# Get local path of a source, if it is a local mirror
+def local_path(source):
+    ''' This function returns the local path of a source given as a directory
+    or file:// URL, or None if the source is remote.'''
+    parsed = urllib.parse.urlparse(source)
+    if parsed.scheme == "file":
+        return urllib.request.url2pathname(parsed.path)
+    if "://" not in source:
+        return source
+    return None
+
+
+# Get total size of a remote file from the Content-Range of a response
+def range_size(headers):
+    ''' This function returns the total size of a remote file given in the
+    Content-Range header of a response (e.g. "bytes 10-99/100" or
+    "bytes */100"), or None if absent.'''
+    total = (headers.get("Content-Range") or "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+# Get total size of a remote file from the headers of a response
+def response_size(headers, offset=0):
+    ''' This function returns the total size of a remote file given the
+    headers of a response, from the Content-Range if present, otherwise from
+    the Content-Length plus the offset at which the response starts. Returns
+    None if unknown.'''
+    size = range_size(headers)
+    if size is not None:
+        return size
+    length = headers.get("Content-Length")
+    if length is not None:
+        return int(length) + offset
+    return None
+
+
+# Get total size of a remote file without downloading it
+def remote_size(url):
+    ''' This function returns the size of the file at a remote url from the
+    headers of a HEAD request, or None if unknown.'''
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return response_size(response.headers)
+
+
+# Open a stream of a file from a source, starting at an offset
+def open_source(url, offset=0):
+    ''' This function opens the file at url (a remote URL, file:// URL or
+    local path) for reading from offset bytes onwards. Returns the stream,
+    the total size of the file (None if unknown) and whether reading
+    resumes at offset (otherwise the stream starts at the beginning, e.g.
+    where a server does not support ranges).'''
+
+    # Open local file directly, seeking to offset
+    path = local_path(url)
+    if path is not None:
+        size = os.path.getsize(path)
+        stream = open(path, "rb")
+        stream.seek(min(offset, size))
+        return stream, size, True
+
+    # Request remaining bytes from remote server
+    request = urllib.request.Request(url)
+    if offset > 0 and url.startswith("http"):
+        request.add_header("Range", f"bytes={offset}-")
+    try:
+        stream = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        # No bytes remain after offset; the partial file is complete only if
+        # it matches the total size (checked by the caller)
+        if e.code == 416:
+            size = range_size(e.headers) if e.headers else None
+            if size is None:
+                size = remote_size(url)
+            return io.BytesIO(), size, True
+        raise
+
+    # Get total size, depending on whether the range was served
+    resumed = offset > 0 and getattr(stream, "status", None) == 206
+    size = response_size(stream.headers, offset if resumed else 0)
+
+    # Return result
+    return stream, size, resumed
+
+
+# Get expected checksum of a file from a source, if published
+def source_checksum(url):
+    ''' This function returns the SHA-256 checksum published alongside the
+    file at url (as url + ".sha256", e.g. in a local mirror), or None if
+    there is none.'''
+    try:
+        stream, _, _ = open_source(url + ".sha256")
+        with stream:
+            return stream.read().decode("utf-8").split()[0].lower()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# Download one raster file from WorldPop (or a mirror)
+def download_worldpop(iso, year=worldpop_year, res="1km",
+                      source=worldpop_source, checksum=None,
+                      chunk_mb=download_chunk_mb, retries=download_retries):
+    ''' This function downloads a raster file of population estimates from
+    WorldPop (or a mirror, see worldpop_source) to the wp_directory, at a
+    1km (default) or 100m resolution for the desired country. The file is
+    streamed to disk in chunks of chunk_mb to a partial file, which is
+    resumed by later attempts (or calls) after an interruption, and only
+    moved into place once its size and (if given, or published by the
+    source) SHA-256 checksum are verified. Files already in place are not
+    downloaded again. This can be later expanded to download a direct
+    estimate of the number of buildings (where possible).'''
+
+    # Arrange url and desired path
+    url = f"{source.rstrip('/')}/{worldpop_path(iso, year, res)}"
+    wp_name = f"{iso.lower()}_ppp_{year}.tif"
     file_path = os.path.join(wp_directory, wp_name)
+    part_path = file_path + ".part"
+    os.makedirs(wp_directory, exist_ok=True)
+
+    # Get expected checksum
+    if checksum is None:
+        checksum = source_checksum(url)
+
+    # Skip files already in place (only moved there once verified)
+    if os.path.exists(file_path) and (
+            checksum is None
+            or file_fingerprint(file_path, content=True) == checksum.lower()):
+        return f"Already downloaded to {file_path}"
+
+    # Download, resuming partial file on each attempt
+    for attempt in range(1, retries + 1):
+        try:
+
+            # Open source from end of partial file
+            offset = 0
+            if os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
+            stream, size, resumed = open_source(url, offset)
+
+            # Stream to partial file in chunks (restart if not resumed)
+            with stream, open(part_path, "ab" if resumed else "wb") as f:
+                for chunk in iter(lambda: stream.read(int(chunk_mb * 1024**2)),
+                                  b""):
+                    f.write(chunk)
+            break
 
-    # Write to raster path
-    f = open(file_path, 'wb')
-    f.write(r.read())
-    f.close()
+        except OSError as e:
+            # Keep partial file, such that next attempt resumes it (missing
+            # files are not retried)
+            missing = isinstance(e, FileNotFoundError) or (
+                isinstance(e, urllib.error.HTTPError) and e.code < 500
+                )
+            if missing or attempt == retries:
+                raise
+            print_yellow(f"WARNING: Download of {url} interrupted ({e}), retrying")
+            time.sleep(attempt)
+
+    # Verify size (a partial file of unknown size is only kept if its
+    # checksum can be verified)
+    actual = os.path.getsize(part_path)
+    if (size is not None and actual != size) or (size is None and resumed
+                                                  and checksum is None):
+        os.remove(part_path)
+        raise IOError(f"Size of {url} is {actual} bytes, expected {size} bytes")
+
+    # Verify checksum
+    if checksum is not None:
+        digest = file_fingerprint(part_path, content=True)
+        if digest != checksum.lower():
+            os.remove(part_path)
+            raise IOError(f"Checksum of {url} is {digest}, expected {checksum}")
+
+    # Move into place
+    os.replace(part_path, file_path)
 
     return f"Downloaded to {file_path}"
 
 
+# Download rasters of many countries concurrently
+def download_many(isos, year=worldpop_year, res="1km", source=worldpop_source,
+                  n_workers=download_workers):
+    ''' This function downloads the rasters of several countries (see
+    download_worldpop) using a pool of n_workers threads. Failures are caught
+    and reported per country, such that one failing download never aborts
+    the others. Returns a dict mapping each ISO code to its status ("done"
+    or "failed") and message (or error).'''
+
+    # Submit one download per country
+    results = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {
+            pool.submit(download_worldpop, iso, year, res, source): iso
+            for iso in dict.fromkeys(isos)
+            }
+
+        # Collect results as downloads finish
+        for future in as_completed(futures):
+            iso = futures[future]
+            try:
+                results[iso] = {"status": "done", "message": future.result()}
+                print(f"{iso}: {results[iso]['message']}")
+            except Exception:
+                results[iso] = {"status": "failed",
+                                "message": traceback.format_exc()}
+                print_red(f"{iso}: download failed\n{results[iso]['message']}")
+
+    # Return result
+    return results
+
+
 # Run main function if called as script
 if __name__ == "__main__":
 
-    # Parse arguments (group name)
-    iso = sys.argv[1]
-    year = 2020
-    res = "1km"
-    if len(sys.argv) > 2:
-        res = sys.argv[2]
+    # Parse arguments (ISO codes and resolution)
+    parser = argparse.ArgumentParser(
+        description="Download WorldPop population rasters."
+        )
+    parser.add_argument("isos", nargs="+",
+                        help="ISO 3166-1 alpha-3 codes of the countries")
+    parser.add_argument("--res", choices=worldpop_resolutions, default="1km",
+                        help="resolution of the population estimates")
+    parser.add_argument("--year", type=int, default=worldpop_year,
+                        help="year of the population estimates")
+    parser.add_argument("--source", default=worldpop_source,
+                        help="WorldPop server or local mirror (directory or file:// URL)")
+    parser.add_argument("--workers", type=int, default=download_workers,
+                        help="number of concurrent downloads")
+    args = parser.parse_args()
+
+    # Accept resolution after the ISO codes (e.g. "AUT 100m")
+    isos = [iso for iso in args.isos if iso not in worldpop_resolutions]
+    res = ([args.res] + [iso for iso in args.isos
+                         if iso in worldpop_resolutions])[-1]
 
     # Call function
-    download_worldpop(iso, year, res)
+    results = download_many(isos, args.year, res, args.source, args.workers)
+    n_failed = sum(r["status"] != "done" for r in results.values())
+    if n_failed:
+        print_red(f"IMPORTANT WARNING: {n_failed} of {len(results)} downloads failed")
+        sys.exit(1)
@@ -0,0 +1,94 @@
+# ------------------------------------------------------------------------------
+#   LOADING DEPENDENCIES AND INPUTS
+# ------------------------------------------------------------------------------
+
+import argparse
+import types
+import _config
+from _config import *
+from util.cache import cache_stats, evict_lru
+
+
+# Caches and their directories
+caches = {
+    "raster": raster_cache_dir,
+    "grid": grid_cache_dir,
+    "bounds": incremental_dir,
+}
+
+
+# ------------------------------------------------------------------------------
+#   DEFINE INFO FUNCTIONS
+# ------------------------------------------------------------------------------
+
+# List settings of _config.py
+def list_config(pattern=None):
+    ''' This function prints the name and value of every setting defined in
+    _config.py (skipping modules and helper functions), optionally only those
+    whose name contains pattern.'''
+
+    # Print each setting
+    for key, value in vars(_config).items():
+        if key.startswith("_") or isinstance(value, types.ModuleType):
+            continue
+        if callable(value) and getattr(value, "__module__", None) != "_config":
+            continue
+        if pattern is not None and pattern.lower() not in key.lower():
+            continue
+        print(f"{key} = {value!r}")
+
+
+# List content of caches
+def list_caches(clear=None):
+    ''' This function prints the number of files and size of each cache
+    (incremental results per country and group for the bounds cache). If
+    clear names a cache (or "all"), its entries are removed first.'''
+
+    # Print each cache
+    for cache_name, cache_dir in caches.items():
+
+        # Arrange directories of cache (one per country and group for bounds)
+        cache_dirs = [cache_dir]
+        if cache_name == "bounds" and os.path.isdir(cache_dir):
+            cache_dirs = sorted(e.path for e in os.scandir(cache_dir)
+                                if e.is_dir())
+
+        # Clear and print each directory
+        for path in cache_dirs:
+            if clear in (cache_name, "all") and os.path.isdir(path):
+                removed = evict_lru(path, 0)
+                print(f"Removed {len(removed)} files from {path}")
+            stats = cache_stats(path)
+            print(f"{cache_name.title()} cache ({path}): {stats['files']} "
+                  f"files, {stats['size_mb']:.1f} MB")
+
+
+# ------------------------------------------------------------------------------
+#   CALLING INFO FUNCTION
+# ------------------------------------------------------------------------------
+
+
+# Run info command if called as script
+if __name__ == "__main__":
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description="List settings and caches of the spatial disaggregation."
+        )
+    commands = parser.add_subparsers(dest="command", required=True)
+    config_parser = commands.add_parser("config", help="list settings")
+    config_parser.add_argument(
+        "pattern", nargs="?", help="only list settings containing pattern"
+        )
+    cache_parser = commands.add_parser("cache", help="list caches")
+    cache_parser.add_argument(
+        "--clear", choices=list(caches) + ["all"],
+        help="remove all entries of a cache first"
+        )
+    args = parser.parse_args()
+
+    # Call function
+    if args.command == "config":
+        list_config(args.pattern)
+    else:
+        list_caches(args.clear)
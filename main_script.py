@@ -4,47 +4,52 @@
 
 import time
 from _config import *
+import numpy as np
+import pandas as pd
 from parsers.exposure import parse_adm, parse_exposure
-from util.geo import resample_raster_to_resolution, associate_grid_to_bounds, add_excepted_bounds
-from util.model import write_model
-from calcs.sampling import resample_assets
+from util.geo import resample_raster_to_resolution, cached_associate_grid_to_bounds, grid_cache_path, add_excepted_bounds, GridIndex
+from util.raster import AggregatedRaster, CovariateStack
+from util.model import write_model, ModelWriter
+from calcs.sampling import resample_assets, derive_seed, grid_partition, grid_cells
+from calcs.weighting import population_to_counts
+from util.profiling import Profiler
 
 
 # ------------------------------------------------------------------------------
-#   DEFINE MAIN FUNCTION
+#   DEFINE GRID PREPARATION FUNCTION
 # ------------------------------------------------------------------------------
 
-def main(mapped_field, desired_level, country_name, country_iso, group):
-    ''' This function takes in an input exposure model CSV along with a
-    corresponding administrative boundaries shapefile, and then resamples
-    the assets in that exposure model to a finer resolution using external
-    datasets (e.g. WorldPop). This requires a matching field between the input
-    exposure CSV and the input admin bounds shapefile (mapped_field). This
-    also requires the population raster dataset (see download_worldpop.py).
-    There are several parameters specified in the _config.py, including the
-    anticipated file names/directories, the desired resolution, and the
-    desired coordinate reference system.'''
+def prepare_grid(mapped_field, desired_level, country_name, country_iso,
+                 profiler=None):
+    ''' This function reads the admin bounds, resamples the population raster
+    (e.g. WorldPop), associates its grid points with the admin bounds and
+    estimates building counts, i.e. everything that can be shared between
+    the groups of a country (see batch_script.py).'''
 
-    # --------------------------------------------------------------------------
-    #   PRINT INFO FOR USER
-    # --------------------------------------------------------------------------
+    # Record stages even if no profiler is given
+    if profiler is None:
+        profiler = Profiler()
 
     # Arrange full WP path
     wp_name = f"{country_iso.lower()}_ppp_{worldpop_year}.tif"
     wp_path = os.path.join(wp_directory, wp_name)
 
     # Arrange full shapefile path
-    shp_path = os.path.join(shp_directory, shp_file)
+    shp_name = shp_template.format(adm_level=desired_level, name=country_name)
+    shp_path = os.path.join(shp_directory, shp_name)
 
-    # Arrange full exposure
-    exp_name = f"Exposure_{group}_{country}.csv"
-    exp_path = os.path.join(exp_directory, exp_name)
+    # Arrange full covariate paths
+    covariate_paths = {
+        name: (path.format(iso=country_iso.lower()), how)
+        for name, (path, how) in covariates.items()
+        }
 
     # Print information
     print(f"\nThis code is using the following files:")
-    print(f"- Original exposure: {exp_path}")
     print(f"- Corresponding admin divisions: {shp_path}")
     print(f"- WorldPop data: {wp_path}")
+    for name, (path, _) in covariate_paths.items():
+        print(f"- Covariate {name}: {path}")
     print(f"Both exposure and admin division files expected to have field {mapped_field}. Target resolution is {res}.\n")
     print("If any of this information seems incorrect, please check input parameters within _config.py\n")
 
@@ -54,21 +59,40 @@ def main(mapped_field, desired_level, country_name, country_iso, group):
 
     # Read admin bounds, which must exist locally
     # This will also associate desired admin shp and associated field
-    adm = parse_adm(shp_path)
+    with profiler.stage("parse_adm") as stage:
+        adm = parse_adm(shp_path)
+        stage["rows"] = adm.shape[0]
 
     # --------------------------------------------------------------------------
     #   MERGE RASTERS AND ASSOCIATE POINTS TO ADMIN BOUNDS
     # --------------------------------------------------------------------------
 
     # Resample (aggregate) WorldPop grid to specified coarser resolution
-    wp_path = resample_raster_to_resolution(
-        wp_path, wp_name, res
-        )
+    with profiler.stage("resample_raster"):
+        wp_path = resample_raster_to_resolution(
+            wp_path, wp_name, res
+            )
+
+        # Stack covariates on top of WorldPop grid (aligned on the fly), such
+        # that all layers are associated with admin bounds in the same pass
+        raster = wp_path
+        if covariate_paths:
+            raster = CovariateStack(wp_path, covariate_paths)
+
+        # Aggregate in memory within this stage, unless the grid association
+        # is reused from cache or aggregates window by window
+        if (isinstance(wp_path, AggregatedRaster) and grid_method != "windowed"
+                and not os.path.exists(grid_cache_path(
+                    raster, adm, mapped_field, value_name='wp'))):
+            wp_path.load()
 
     # Associate grid points from raster data to admin bounds (at desired level)
-    wp, e_wp = associate_grid_to_bounds(
-        wp_path, adm, mapped_field, value_name='wp'
-        )
+    # NOTE: Reused from cache if raster and admin bounds are unchanged
+    with profiler.stage("associate_grid") as stage:
+        wp, e_wp = cached_associate_grid_to_bounds(
+            raster, adm, mapped_field, value_name='wp', with_geometry=False
+            )
+        stage["rows"] = wp.shape[0]
 
     # Find union of failed mapped_field values (where there are no pixels)
     exceptions = list(set(e_wp))
@@ -76,20 +100,84 @@ def main(mapped_field, desired_level, country_name, country_iso, group):
     if exceptions:
         print_yellow(f"WARNING: Could not find any pixel values for: {exceptions}")
 
-    # Combine dataframes based on row and column index
-    # NOTE: This is left for future development where multiple datasets used
-    df = wp.copy()
+    # Grid holds WorldPop and covariates (if any) of each grid point
+    df = wp
 
     # --------------------------------------------------------------------------
     #   ESTIMATE BUILDING COUNTS
     # --------------------------------------------------------------------------
 
-    # Apply population_to_buildings function to estimate buildding count from
-    # population estimate (Adjust as needed from the config file)
-    df['count'] = population_to_buildings(df["wp"])
+    # Apply population_weighting (or population_to_buildings) function to
+    # estimate buildding count from population estimate (Adjust as needed from
+    # the config file), or
+    # covariates_to_buildings to estimate it from all layers
+    with profiler.stage("estimate_counts") as stage:
+        if covariates_to_buildings is not None:
+            layers = {name: df[name].to_numpy()
+                      for name in ["wp"] + list(covariate_paths)}
+            df['count'] = covariates_to_buildings(layers)
+        else:
+            df['count'] = population_to_counts(df["wp"].to_numpy())
+        stage["rows"] = df.shape[0]
+
+    # Arrange spatial index of grid points (built on first use, e.g. to find
+    # the nearest grid point of bounds without pixels in any group)
+    grid_index = GridIndex.from_frame(df)
+
+    # Return result
+    return adm, df, grid_index
+
 
-    # Arrange data by fields used for taxonomy mapping
-    bound_names = df[mapped_field].unique()
+# ------------------------------------------------------------------------------
+#   DEFINE MAIN FUNCTION
+# ------------------------------------------------------------------------------
+
+def main(mapped_field, desired_level, country_name, country_iso, group,
+         grid=None, seed=seed, writer=None, profiler=None):
+    ''' This function takes in an input exposure model CSV along with a
+    corresponding administrative boundaries shapefile, and then resamples
+    the assets in that exposure model to a finer resolution using external
+    datasets (e.g. WorldPop). This requires a matching field between the input
+    exposure CSV and the input admin bounds shapefile (mapped_field). This
+    also requires the population raster dataset (see download_worldpop.py).
+    There are several parameters specified in the _config.py, including the
+    anticipated file names/directories, the desired resolution, and the
+    desired coordinate reference system. A grid from prepare_grid can be
+    passed to skip its preparation, and a ModelWriter as writer to write the
+    model bound by bound (returning None).'''
+
+    # Record stages even if no profiler is given
+    if profiler is None:
+        profiler = Profiler()
+
+    # --------------------------------------------------------------------------
+    #   PRINT INFO FOR USER
+    # --------------------------------------------------------------------------
+
+    # Arrange full exposure
+    exp_name = f"Exposure_{group}_{country_name}.csv"
+    exp_path = os.path.join(exp_directory, exp_name)
+
+    # Print information
+    print(f"- Original exposure: {exp_path}")
+
+    # --------------------------------------------------------------------------
+    #   PREPARE ADMIN BOUNDS AND GRID
+    # --------------------------------------------------------------------------
+
+    # Prepare grid unless already available (e.g. from another group)
+    if grid is None:
+        grid = prepare_grid(mapped_field, desired_level, country_name,
+                            country_iso, profiler=profiler)
+    adm, df, grid_index = grid
+
+    # Arrange grid cells by fields used for taxonomy mapping (looked up from
+    # the admin bound of each grid point)
+    # NOTE: Grids ordered by admin bound (e.g. shared between groups) are
+    # sliced in place rather than copied
+    names = adm[mapped_field].to_numpy()
+    cells = grid_cells(df, grid_partition(df['adm_code'].to_numpy(), names))
+    bound_names = np.asarray(list(cells))
 
     # --------------------------------------------------------------------------
     #   PARSE INPUT EXPOSURE DATA
@@ -99,17 +187,27 @@ def main(mapped_field, desired_level, country_name, country_iso, group):
     # csv for GRM)
     # Also going to get list of distinct mapped_field values to understand
     # important exceptions during raster resampling
-    assets, distinct_field = parse_exposure(country_name, group, mapped_field)
+    with profiler.stage("parse_exposure") as stage:
+        assets, distinct_field = parse_exposure(country_name, group,
+                                                mapped_field)
+        stage["rows"] = assets.shape[0]
     important_exceptions = list(
-        np.setdiff1d(distinct_field, df[mapped_field].unique())
+        np.setdiff1d(distinct_field, bound_names)
         )
     if important_exceptions:
         print_red(f"IMPORTANT WARNING: Will not be able to properly distribute {important_exceptions}; using nearest raster values instead")
-        # Add important exceptions to df and raster values from nearest point
-        df = add_excepted_bounds(df, adm, important_exceptions,
-                                 mapped_field)
+        # Add grid cells of important exceptions, with raster values from
+        # nearest point (kept apart from df, such that df is not copied)
+        with profiler.stage("add_excepted_bounds") as stage:
+            df_new = add_excepted_bounds(df, adm, important_exceptions,
+                                         mapped_field, grid_index=grid_index,
+                                         append=False)
+            cells.update(grid_cells(df_new, grid_partition(
+                df_new['adm_code'].to_numpy(), names
+                )))
+            stage["rows"] = len(important_exceptions)
         # Update bound_names accordingly
-        bound_names = df[mapped_field].unique()
+        bound_names = np.asarray(list(cells))
 
     # Get total number of building counts for future checks
     assets_total = assets["number"].sum()
@@ -119,24 +217,39 @@ def main(mapped_field, desired_level, country_name, country_iso, group):
     # --------------------------------------------------------------------------
 
     # Distribute buildings bound by bound
-    model = resample_assets(df, assets, bound_names, mapped_field)
-
-    # Remove sites with no assets allocated
-    model = model[(model['number'] != 0)]
+    # NOTE: In incremental mode, only bounds whose inputs changed since the
+    # previous run are resampled
+    store_dir = None
+    if incremental:
+        store_dir = os.path.join(incremental_dir, f"{country_name}_{group}")
+    # NOTE: If a writer is given, each bound is written as soon as it is
+    # sampled, such that the full model is never held in memory
+    on_bound = None
+    if writer is not None:
+        on_bound = lambda samples: writer.write(arrange_model(samples))
+    # NOTE: With a writer, this stage includes writing the model
+    stage_name = "sample_assets" if writer is None else "sample_and_write"
+    with profiler.stage(stage_name) as stage:
+        model = resample_assets(df, assets, bound_names, mapped_field,
+                                seed=derive_seed(seed, country_name, group),
+                                store_dir=store_dir, on_bound=on_bound,
+                                profiler=profiler, cells=cells)
+        stage["rows"] = model.shape[0]
 
     # --------------------------------------------------------------------------
     #   WRITE EXPOSURE MODEL
     # --------------------------------------------------------------------------
 
-    # Rename columns to be in oq format
-    model.rename(columns={
-        "x": "lon",
-        "y": "lat"
-        }, inplace=True)
+    # Remove sites with no assets allocated and rename columns to oq format
+    model = arrange_model(model)
 
     # Preview result
-    print(f"There are {model['number'].sum():.0f} buildings in the exposure model")
-    if np.abs(model['number'].sum() - assets_total)/assets_total > thresh:
+    total_number = model['number'].sum()
+    if writer is not None:
+        total_number = writer.total_number
+        model = None
+    print(f"There are {total_number:.0f} buildings in the exposure model")
+    if np.abs(total_number - assets_total)/assets_total > thresh:
         print_red(f"IMPORTANT WARNING: The number of buildings sampled to full taxonomies is less than the known number of buildings in exposure data, which is {assets_total}")
 
     # --------------------------------------------------------------------------
@@ -146,20 +259,71 @@ def main(mapped_field, desired_level, country_name, country_iso, group):
     # Return result
     return model
 
-# ------------------------------------------------------------------------------
-#   CALLING MAIN FUNCTION
-# ------------------------------------------------------------------------------
 
+# Arrange sampled assets in oq format
+def arrange_model(model):
+    ''' This function removes sites with no assets allocated and renames the
+    location columns to those expected by OQ.'''
 
-# Run main function if called as script
-if __name__ == "__main__":
+    # Remove sites with no assets allocated
+    model = model[(model['number'] != 0)]
 
-    # Time code
-    tic = time.perf_counter()
+    # Rename columns to be in oq format
+    model = model.rename(columns={
+        "x": "lon",
+        "y": "lat"
+        })
 
-    # Parse arguments (group name)
-    input = sys.argv[1]
-    group = sys.argv[2].title()
+    # Return result
+    return model
+
+
+# Run main function and write exposure model of one group
+def run_group(mapped_field, desired_level, country_name, country_iso, group,
+              grid=None, seed=seed, profiler=None):
+    ''' This function calls the main function for one group and writes the
+    resulting exposure model, either at once or (if write_partitions is set
+    in _config.py) bound by bound as it is sampled. Unless profile_report is
+    disabled, a report of the time and memory of each stage is written to
+    profile_dir. Returns the path of the written model.'''
+
+    # Arrange output file name
+    file_name = f"Exposure_{group}_{country_name}.csv"
+
+    # Initialize profiler (may already hold stages of the grid preparation)
+    if profiler is None:
+        profiler = Profiler(country=country_name, group=group, seed=seed)
+
+    # Write model bound by bound
+    if write_partitions:
+        with ModelWriter(file_name, group) as writer:
+            main(mapped_field, desired_level, country_name, country_iso,
+                 group, grid=grid, seed=seed, writer=writer,
+                 profiler=profiler)
+        file_path = writer.file_path
+
+    # Otherwise write model for entire group
+    else:
+        model = main(mapped_field, desired_level, country_name, country_iso,
+                     group, grid=grid, seed=seed, profiler=profiler)
+        with profiler.stage("write_model") as stage:
+            file_path = write_model(model, file_name, group)
+            stage["rows"] = model.shape[0]
+
+    # Write profiling report
+    if profile_report:
+        report_path = profiler.write(f"Profile_{group}_{country_name}")
+        print(f"Profiling report written to {report_path}")
+
+    # Return full path
+    return file_path
+
+
+# Find country name and ISO name from mosaic mapping scheme
+def lookup_country(input, mf=None):
+    ''' This function returns the country name and ISO 3166-1 alpha-3 code of
+    a country given either of them (or its short name), using the mosaic
+    mapping scheme. An already loaded mapping scheme can be passed as mf.'''
 
     # Determine whether country code or short name
     key = "short_name"
@@ -167,7 +331,8 @@ if __name__ == "__main__":
         key = "iso_name"
 
     # Read in mapping scheme
-    mf = pd.read_csv(mosaic_mapping, encoding="utf-8", header=0)
+    if mf is None:
+        mf = pd.read_csv(mosaic_mapping, encoding="utf-8", header=0)
     mf = mf.set_index(key)
 
     # Grab relevant mosaic names and country name
@@ -179,11 +344,33 @@ if __name__ == "__main__":
     else:
         iso_name = mf.loc[input, "iso_name"]
 
-    # Call main function  TODO: Write query to read in exposure CSV
-    model = main(field_name, adm_level, country, iso_name, group)
+    # Return result
+    return country, iso_name
+
+
+# ------------------------------------------------------------------------------
+#   CALLING MAIN FUNCTION
+# ------------------------------------------------------------------------------
+
+
+# Run main function if called as script
+if __name__ == "__main__":
+
+    # Time code
+    tic = time.perf_counter()
+
+    # Parse arguments (group name and optional seed)
+    input = sys.argv[1]
+    group = sys.argv[2].title()
+    if len(sys.argv) > 3:
+        seed = int(sys.argv[3])
+
+    # Get country name and ISO name from mapping scheme
+    country, iso_name = lookup_country(input)
 
-    # Write model for entire group
-    write_model(model, f"Exposure_{group}_{country}.csv", group)
+    # Call main function and write model  TODO: Write query to read in
+    # exposure CSV
+    run_group(field_name, adm_level, country, iso_name, group, seed=seed)
 
     # Print time estimate
     toc = time.perf_counter()
@@ -1,5 +1,6 @@
 # Load dependencies
 from _config import *
+import pandas as pd
 
 
 # Define function to parse admin bounds shapefile
@@ -7,6 +8,9 @@ def parse_adm(shp_path):
     ''' This function reads in a local shapefile of administrative boundaries,
      of which the input exposure CSV is based upon.'''
 
+    # Import geopandas only when used
+    import geopandas as gpd
+
     # Initialize geodataframes and read files
     adm = gpd.read_file(shp_path, encoding='utf-8').to_crs(desired_crs)
 
@@ -15,23 +19,57 @@ def parse_adm(shp_path):
 
 
 # Parse input exposure CSV
-def parse_exposure(country, group, mapped_field):
+def parse_exposure(country, group, mapped_field, chunksize=exposure_chunksize,
+                   value_dtype=exposure_value_dtype):
     ''' This function reads in a local CSV of the input exposure model,
-     of which the input exposure CSV is based upon.'''
+     of which the input exposure CSV is based upon. Only the columns needed
+     for resampling are read (mapped_field, retain_tags, number and
+     loss_types), with categorical tags and value_dtype values. The file is
+     read in chunks of chunksize rows, each aggregated by mapped_field and
+     retain_tags while reading, such that memory is proportional to the
+     number of distinct classes rather than the number of rows.'''
 
     # Arrange path
     file_name = f"Exposure_{group}_{country}.csv"
     file_path = os.path.join(exp_directory, file_name)
 
-    # Read in CSV
-    assets = pd.read_csv(file_path, encoding="utf-8")
+    # Find required columns in header (mapped_field may be lower case)
+    value_cols = ["number"] + loss_types
+    header = pd.read_csv(file_path, encoding="utf-8", nrows=0).columns
+    field_col = mapped_field
+    if mapped_field not in header:
+        field_col = mapped_field.lower()
+    usecols = [field_col] + retain_tags + value_cols
+
+    # Arrange compact data types
+    dtype = {col: "category" for col in retain_tags}
+    dtype.update({col: value_dtype for col in value_cols})
+
+    # Read in CSV chunk by chunk, aggregating by mapped_field and tags
+    reader = pd.read_csv(file_path, encoding="utf-8", usecols=usecols,
+                         dtype=dtype, chunksize=chunksize)
+    if chunksize is None:
+        reader = [reader]
+    keys = [field_col] + retain_tags
+    partial = [
+        chunk.groupby(keys, observed=True, sort=False)[value_cols].sum()
+        for chunk in reader
+        ]
+
+    # Combine aggregates of all chunks
+    assets = pd.concat(partial).groupby(level=keys, sort=False).sum()
+    assets = assets.reset_index()
 
     # Convert mapped_field into consistent format
     assets = assets.rename(columns={
-        mapped_field.lower(): mapped_field
+        field_col: mapped_field
         })
 
+    # Use categorical data types for tags and mapped_field
+    for col in [mapped_field] + retain_tags:
+        assets[col] = assets[col].astype("category")
+
     # Get distinct field values from query
-    field_values = assets[mapped_field].unique()
+    field_values = assets[mapped_field].unique().to_numpy()
 
     return assets, field_values
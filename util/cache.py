@@ -0,0 +1,269 @@
+# Load dependencies
+from _config import *
+import hashlib
+import json
+import numpy as np
+
+
+# Hits, misses and evictions per cache during this session
+_session_stats = {}
+
+
+# Fingerprint a file based on its location, size and modification time
+def file_fingerprint(file_path, content=cache_content_hash):
+    ''' This function returns a string identifying the current state of a
+    file, based on its absolute path, size and modification time. If content
+    is True, a hash of the full file content is used instead, which is slower
+    for large rasters but robust to files being copied or touched.'''
+
+    # Hash full file content in chunks if requested
+    if content:
+        h = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024**2), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    # Otherwise use path, size and modification time
+    stat = os.stat(file_path)
+    return f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+# Fingerprint the content of NumPy arrays
+def array_fingerprint(*arrays):
+    ''' This function returns a hash of the shape, data type and values of
+    the given arrays.'''
+
+    # Hash each array in turn
+    h = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode("utf-8"))
+        h.update(array.tobytes())
+
+    # Return result
+    return h.hexdigest()
+
+
+# Fingerprint the content of a (Geo)DataFrame
+def frame_fingerprint(df):
+    ''' This function returns a hash of the content of a dataframe, including
+    its column names, index, values and (if present) the well-known binary of
+    its geometries and its CRS, such that any change of the data (e.g. of an
+    admin bounds shapefile) results in a different fingerprint.'''
+
+    # Import pandas and geopandas only when used
+    import pandas as pd
+    import geopandas as gpd
+
+    # Hash column names and attribute values
+    h = hashlib.sha256()
+    h.update(json.dumps([str(col) for col in df.columns]).encode("utf-8"))
+    geom_col = df.geometry.name if isinstance(df, gpd.GeoDataFrame) else None
+    attributes = pd.DataFrame(df.drop(columns=[geom_col] if geom_col else []))
+    h.update(pd.util.hash_pandas_object(attributes, index=True).values.tobytes())
+
+    # Hash geometries and CRS
+    if geom_col:
+        for wkb in df.geometry.to_wkb():
+            h.update(b"" if wkb is None else wkb)
+        h.update(str(df.crs).encode("utf-8"))
+
+    # Return result
+    return h.hexdigest()
+
+
+# Arrange deterministic key from any number of (JSON serializable) parts
+def cache_key(*parts):
+    ''' This function hashes the given parts (e.g. file fingerprints and
+    parameters) into a deterministic hexadecimal key.'''
+
+    # Serialize parts consistently before hashing
+    text = json.dumps(parts, sort_keys=True, default=str)
+
+    # Return result
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Write dataframe to a columnar cache file with optional metadata
+def write_frame(df, file_path, metadata=None, file_format=grid_cache_format):
+    ''' This function writes a dataframe to a Feather (uncompressed, such
+    that it can be memory-mapped) or Parquet file, storing the metadata
+    dictionary (JSON serializable) alongside the table schema. The file is
+    written to a temporary path first and then moved into place.'''
+
+    # Import pandas and pyarrow only when used
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    # Convert to arrow table and attach metadata
+    table = pa.Table.from_pandas(pd.DataFrame(df), preserve_index=False)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[b"cache"] = json.dumps(metadata or {}, default=str)
+    table = table.replace_schema_metadata(schema_metadata)
+
+    # Write to temporary file
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    if file_format == "parquet":
+        pyarrow.parquet.write_table(table, tmp_path)
+    else:
+        pyarrow.feather.write_feather(table, tmp_path,
+                                      compression="uncompressed")
+
+    # Move into place
+    os.replace(tmp_path, file_path)
+
+
+# Read dataframe and metadata from a columnar cache file
+def read_frame(file_path, file_format=grid_cache_format):
+    ''' This function reads a dataframe written by write_frame (memory-mapping
+    the file) and returns it along with its metadata dictionary.'''
+
+    # Import pyarrow only when used
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    # Read arrow table
+    if file_format == "parquet":
+        table = pyarrow.parquet.read_table(file_path, memory_map=True)
+    else:
+        table = pyarrow.feather.read_table(file_path, memory_map=True)
+
+    # Retrieve metadata
+    metadata = json.loads((table.schema.metadata or {}).get(b"cache", b"{}"))
+
+    # Return result
+    return table.to_pandas(), metadata
+
+
+# Write dataframe as memory-mappable arrays to be shared between processes
+def write_shared_frame(df, directory):
+    ''' This function writes each column of a dataframe with numeric columns
+    (e.g. the grid of a country) to a NumPy file in directory, along with
+    the column names, such that other processes can attach to the same
+    physical copy with read_shared_frame. The directory is written to a
+    temporary path first and then moved into place.'''
+
+    # Check that all columns can be memory-mapped
+    for col in df.columns:
+        if df[col].dtype.kind not in "biuf":
+            raise ValueError(f"Column {col} of dtype {df[col].dtype} cannot be shared")
+
+    # Write each column and the column names to temporary directory
+    tmp_dir = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for j, col in enumerate(df.columns):
+        np.save(os.path.join(tmp_dir, f"col_{j}.npy"), df[col].to_numpy())
+    with open(os.path.join(tmp_dir, "columns.json"), "w") as f:
+        json.dump([str(col) for col in df.columns], f)
+
+    # Move into place
+    os.replace(tmp_dir, directory)
+
+
+# Attach to dataframe written by write_shared_frame
+def read_shared_frame(directory):
+    ''' This function memory-maps (read-only) the columns written by
+    write_shared_frame and returns them as a dataframe without copying, such
+    that all processes reading the same directory share one physical copy.
+    The arrays are read-only; frames derived from it (e.g. by
+    add_excepted_bounds) hold their own copies.'''
+
+    # Import pandas only when used
+    import pandas as pd
+
+    # Read column names
+    with open(os.path.join(directory, "columns.json")) as f:
+        columns = json.load(f)
+
+    # Memory-map each column
+    data = {
+        col: np.load(os.path.join(directory, f"col_{j}.npy"), mmap_mode="r")
+        for j, col in enumerate(columns)
+        }
+
+    # Return result
+    return pd.DataFrame(data, copy=False)
+
+
+# Record a cache event (hit, miss or eviction) for the session
+def record(cache_name, event, n=1):
+    stats = _session_stats.setdefault(
+        cache_name, {"hit": 0, "miss": 0, "evicted": 0}
+        )
+    stats[event] += n
+
+
+# Mark a cache entry as recently used
+def touch(file_path):
+    os.utime(file_path, None)
+
+
+# Remove least recently used entries until cache fits within max_mb
+def evict_lru(cache_dir, max_mb, keep=(), cache_name=None):
+    ''' This function removes the least recently used (i.e. oldest
+    modification time) files from the cache_dir until the total size of the
+    cache is at most max_mb, except for files listed in keep. Returns the
+    list of removed files.'''
+
+    # List cache entries from oldest to newest
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+
+    # Remove oldest entries until the cache fits
+    keep = {os.path.abspath(k) for k in keep}
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in entries:
+        if total <= max_mb * 1024**2:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        os.remove(path)
+        total -= size
+        removed.append(path)
+
+    # Record evictions
+    if cache_name is not None and removed:
+        record(cache_name, "evicted", len(removed))
+
+    # Return result
+    return removed
+
+
+# Summarize content of a cache directory
+def cache_stats(cache_dir, cache_name=None):
+    ''' This function returns the number of files and total size (in MB) of
+    a cache directory, along with the session hits, misses and evictions of
+    the named cache.'''
+
+    # Count entries and size
+    n_files, size = 0, 0
+    if os.path.isdir(cache_dir):
+        for entry in os.scandir(cache_dir):
+            if entry.is_file():
+                n_files += 1
+                size += entry.stat().st_size
+
+    # Combine with session statistics
+    stats = {"files": n_files, "size_mb": size / 1024**2}
+    stats.update(
+        _session_stats.get(cache_name, {"hit": 0, "miss": 0, "evicted": 0})
+        )
+
+    # Return result
+    return stats
+
+
+# Print summary of a cache directory
+def print_cache_stats(cache_dir, cache_name):
+    stats = cache_stats(cache_dir, cache_name)
+    print(f"{cache_name.title()} cache ({cache_dir}): {stats['files']} files, "
+          f"{stats['size_mb']:.1f} MB; {stats['hit']} hits, "
+          f"{stats['miss']} misses, {stats['evicted']} evicted")
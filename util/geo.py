@@ -1,51 +1,176 @@
 # Load dependencies
 from _config import *
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import rasterio.features
+import rasterio.mask
+import rasterio.windows
+from rasterio import Affine
+from scipy.spatial import cKDTree
+from util.cache import (file_fingerprint, frame_fingerprint, cache_key, record,
+                        touch, evict_lru, print_cache_stats, write_frame,
+                        read_frame)
+import rasterio.io
+from util.raster import AggregatedRaster, CovariateStack
+
+
+# Version of the layout of associated grids, such that grids cached with an
+# earlier layout are not reused
+grid_layout = 2
 
 
 # Resample one raster to desired grid resolution
 def resample_raster_to_resolution(original_raster, file_name, res,
-                                  sample_agg="average"):
+                                  sample_agg=raster_aggregation,
+                                  engine=raster_engine):
     ''' This function resamples the existing raster data (e.g. WorldPop) to
     a coarser desired resolution (res) and aggregated the values using the
-    sample_agg. At the time of creation, there was no SUM option and so
-    the AVERAGE option was used'''
+    sample_agg ("sum", "mean" or "max"). With the "numpy" engine, an
+    AggregatedRaster is returned, which aggregates in memory on first use
+    and can be passed to associate_grid_to_bounds in place of a path. With
+    the "gdal" engine, resampled rasters are written to raster_cache_dir,
+    keyed by the source raster, res, sample_agg and CRS, such that GDAL is
+    only called once for the same inputs, and the path is returned.'''
 
     # Confirm raster file exists
     if not os.path.exists(original_raster):
         print_red(f"ERROR: You need to download raster data first, could not find {original_raster}.")
 
-    # Arrange new file name
-    new_raster = original_raster.replace(file_name, "resampled_" + file_name)
+    # Aggregate in memory if requested
+    if sample_agg == "average":
+        sample_agg = "mean"
+    if engine == "numpy":
+        return AggregatedRaster(original_raster, res, sample_agg)
+
+    # Import GDAL only when used
+    from osgeo import gdal
+
+    # Arrange cache key from source raster and resampling parameters
+    src = gdal.Open(original_raster)
+    crs = src.GetProjection()
+    src = None  # close dataset
+    key = cache_key(file_fingerprint(original_raster), res, sample_agg, crs)
+
+    # Arrange new file name within cache
+    os.makedirs(raster_cache_dir, exist_ok=True)
+    new_raster = os.path.join(raster_cache_dir,
+                              f"resampled_{key[:16]}_{file_name}")
+
+    # Reuse previously resampled raster if available
+    if os.path.exists(new_raster):
+        touch(new_raster)
+        record("raster", "hit")
+
+    # Otherwise resample and add to cache
+    else:
+        record("raster", "miss")
+
+        # Bound memory used by GDAL for caching raster blocks
+        gdal.SetCacheMax(int(max_memory_mb * 1024**2))
+
+        # Call GDAL translate (write to temporary file first, such that
+        # interrupted runs never leave incomplete rasters in the cache)
+        resample_alg = {"mean": "average"}.get(sample_agg, sample_agg)
+        kwargs = {"xRes": res, "yRes": res, "resampleAlg": resample_alg,
+                  "format": 'GTiff'}
+        tmp_raster = f"{new_raster}.{os.getpid()}.tmp"
+        _ = gdal.Translate(tmp_raster, original_raster, **kwargs)
+        _ = None  # flush and close dataset
+        os.replace(tmp_raster, new_raster)
+
+        # Remove least recently used rasters if cache is too large
+        evict_lru(raster_cache_dir, raster_cache_max_mb, keep=[new_raster],
+                  cache_name="raster")
 
-    # Call GDAL translate
-    kwargs = {"xRes": res, "yRes": res, "resampleAlg": sample_agg,
-              "format": 'GTiff'}
-    _ = gdal.Translate(new_raster, original_raster, **kwargs)
+    # Print cache statistics
+    print_cache_stats(raster_cache_dir, "raster")
 
     # Return new path
     return new_raster
 
+# Spatial index of grid points for nearest neighbour lookups
+class GridIndex:
+    ''' This class holds a KD-tree over the x/y locations of grid points,
+    which is built once (lazily, on the first query) and can then be reused
+    for any number of nearest neighbour queries, e.g. across all exceptions
+    of a country and across its groups (see prepare_grid). Until then only
+    references to x and y are held. Queries return positions in the arrays
+    the index was built from.'''
+
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+        self._tree = None
+
+    # Build index from the x/y columns of a dataframe
+    @classmethod
+    def from_frame(cls, df):
+        return cls(df["x"].to_numpy(), df["y"].to_numpy())
+
+    # Number of indexed points
+    def __len__(self):
+        return len(self.x)
+
+    # Find nearest grid point of each location
+    def query(self, x, y):
+        ''' This function returns the distance to and position of the nearest
+        indexed grid point for each of the locations x, y (arrays).'''
+
+        # Build tree on first use
+        if self._tree is None:
+            self._tree = cKDTree(np.column_stack([
+                np.asarray(self.x, dtype=np.float64),
+                np.asarray(self.y, dtype=np.float64)
+                ]))
+
+        # Query all locations at once
+        locations = np.column_stack([np.asarray(x, dtype=np.float64),
+                                     np.asarray(y, dtype=np.float64)])
+        return self._tree.query(locations, k=1)
+
+
+# Get coordinates of (Geo)DataFrame as arrays
+def frame_coordinates(gdf):
+    ''' This function returns the x and y coordinates of a dataframe (from its
+    x/y columns if present, otherwise from its geometry) along with the row
+    position of each coordinate, as non-point geometries have several.'''
+
+    # Use x/y columns or point geometries directly
+    if {'x', 'y'}.issubset(gdf.columns):
+        x, y = gdf['x'].to_numpy(), gdf['y'].to_numpy()
+        return x, y, np.arange(gdf.shape[0])
+    if (gdf.geometry.geom_type == 'Point').all():
+        x, y = gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy()
+        return x, y, np.arange(gdf.shape[0])
+
+    # Otherwise get all vertices of each geometry
+    coords = [np.array(geom.coords) for geom in gdf.geometry.to_list()]
+    rows = np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    coords = np.concatenate(coords)
+    return coords[:, 0], coords[:, 1], rows
+
+
 # Find nearest points between two dataframes and return associated columns
-def ckdnearest(gdfA, gdfB, gdfB_cols=['count']):
+def ckdnearest(gdfA, gdfB, gdfB_cols=['count'], index=None):
+    ''' This function adds the gdfB_cols of the nearest point of gdfB (and
+    the distance to it) to each point of gdfA. A GridIndex of gdfB can be
+    passed as index to reuse it across calls.'''
+
     # Drop columns if they exist
-    if 'dist' in gdfA.columns.to_list():
-        gdfA.drop(columns=gdfB_cols+['dist'], inplace=True)
-    else:
-        gdfA.drop(columns=gdfB_cols, inplace=True)
+    gdfA = gdfA.drop(columns=[c for c in gdfB_cols + ['dist']
+                              if c in gdfA.columns])
     # resetting the index of gdfA and gdfB here.
     gdfA = gdfA.reset_index(drop=True)
     gdfB = gdfB.reset_index(drop=True)
-    # Arranging locations
-    A = np.concatenate(
-        [np.array(geom.coords) for geom in gdfA.geometry.to_list()])
-    B = [np.array(geom.coords) for geom in gdfB.geometry.to_list()]
-    B_ix = tuple(itertools.chain.from_iterable(
-        [itertools.repeat(i, x) for i, x in enumerate(list(map(len, B)))]))
-    B = np.concatenate(B)
-    # Finding nearest point
-    ckd_tree = cKDTree(B)
-    dist, idx = ckd_tree.query(A, k=1)
-    idx = itemgetter(*idx)(B_ix)
+    # Arranging locations and spatial index of gdfB
+    xA, yA, _ = frame_coordinates(gdfA)
+    xB, yB, B_ix = frame_coordinates(gdfB)
+    if index is None:
+        index = GridIndex(xB, yB)
+    # Finding nearest point (as row of gdfB)
+    dist, idx = index.query(xA, yA)
+    idx = B_ix[idx]
     # Getting corresponding column values
     gdf = pd.concat(
         [gdfA, gdfB.loc[idx, gdfB_cols].reset_index(drop=True),
@@ -54,12 +179,305 @@ def ckdnearest(gdfA, gdfB, gdfB_cols=['count']):
     return gdf
 
 
+# Burn admin bounds into a label grid aligned with the raster data
+def rasterize_bounds(adm_level, out_shape, transform, ids=None):
+    ''' This function burns all geometries of a GeoDataFrame into a single
+    grid of shape out_shape (aligned with transform), where each pixel holds
+    the id of the admin bound covering the pixel centre, or -1 where no
+    admin bound is found. By default, the id is the position of the admin
+    bound within the GeoDataFrame.'''
+
+    # Default to positional index as burn value
+    if ids is None:
+        ids = range(adm_level.shape[0])
+
+    # Arrange shapes with their burn value
+    shapes = [(geom, i) for i, geom in zip(ids, adm_level.geometry)
+              if geom is not None and not geom.is_empty]
+
+    # Return empty grid if there is nothing to burn
+    if not shapes:
+        return np.full(out_shape, -1, dtype="int32")
+
+    # Burn all admin bounds in one pass
+    labels = rasterio.features.rasterize(
+        shapes, out_shape=out_shape, transform=transform, fill=-1,
+        dtype="int32"
+        )
+
+    # Return result
+    return labels
+
+
+# Get number of layers read from a raster (target and covariates, if any)
+def n_layers(src):
+    return 1 + len(getattr(src, "covariate_names", []))
+
+
+# Split raster into windows that fit within the memory ceiling
+def raster_windows(src, max_memory=max_memory_mb):
+    ''' This function splits an open raster into windows of full rows, such
+    that the data and labels held for a single window do not exceed
+    max_memory (in MB). Windows are aligned with the internal blocks of the
+    raster where possible.'''
+
+    # Estimate memory per raster row (values of all layers, labels and
+    # validity mask)
+    itemsize = np.dtype(src.dtypes[0]).itemsize * n_layers(src)
+    row_bytes = src.width * (itemsize + np.dtype("int32").itemsize + 2)
+
+    # Get number of rows per window, aligned with block height
+    n_rows = max(1, int(max_memory * 1024**2 // row_bytes))
+    block_height = src.block_shapes[0][0]
+    if n_rows > block_height:
+        n_rows -= n_rows % block_height
+
+    # Yield windows
+    for row_off in range(0, src.height, n_rows):
+        yield rasterio.windows.Window(
+            0, row_off, src.width, min(n_rows, src.height - row_off)
+            )
+
+
+# Extract pixels within a raster window and label them with admin bounds
+def label_window(src, adm_level, window, adm_bounds=None, remove_zeros=False):
+    ''' This function reads one window of an open raster, burns the admin
+    bounds intersecting that window into a label grid, and returns the row
+    and column indices (relative to the full raster), values (one row per
+    layer, see CovariateStack) and positional admin bound labels of all
+    valid pixels. Validity is determined by the first layer.'''
+
+    # Read raster data within window (first band, and covariates if any)
+    data = src.read(list(range(1, n_layers(src) + 1)), window=window)
+    transform = src.window_transform(window)
+    no_data = src.nodata
+
+    # Only burn admin bounds that intersect the window
+    if adm_bounds is None:
+        adm_bounds = adm_level.geometry.bounds.to_numpy()
+    left, bottom, right, top = rasterio.windows.bounds(window, src.transform)
+    ids = np.flatnonzero(
+        (adm_bounds[:, 0] <= right) & (adm_bounds[:, 2] >= left) &
+        (adm_bounds[:, 1] <= top) & (adm_bounds[:, 3] >= bottom)
+        )
+
+    # Label each pixel with the position of its admin bound
+    labels = rasterize_bounds(adm_level.iloc[ids], data.shape[1:], transform,
+                              ids)
+
+    # Remove pixels outside of bounds and nodata values
+    valid = (labels >= 0)
+    if no_data is not None:
+        valid &= (data[0] != no_data)
+    if remove_zeros:
+        valid &= (data[0] != 0)
+    r, c = np.nonzero(valid)
+    values = data[:, r, c]
+    labels = labels[r, c]
+
+    # Return result (offset to full raster)
+    return r + window.row_off, c + window.col_off, values, labels
+
+
+# Convert pixel row and column indices to coordinates of pixel centres
+def pixel_centres(r, c, transform):
+    ''' This function applies the affine transform of a raster to arrays of
+    row and column indices at once, and returns the x and y arrays of the
+    corresponding pixel centres.'''
+
+    # Reference pixel centre
+    T1 = transform * Affine.translation(0.5, 0.5)
+
+    # Apply affine transform to all pixels
+    x = T1.a * c + T1.b * r + T1.c
+    y = T1.d * c + T1.e * r + T1.f
+
+    # Return result
+    return x, y
+
+
+# Arrange pixels extracted from a raster into a dataframe
+def pixels_to_frame(r, c, values, transform, value_name='val',
+                    with_geometry=True):
+    ''' This function takes the row and column indices of pixels (relative to
+    the transform) and their values, and returns a dataframe with the
+    geolocation of each pixel centre. Several layers of values (one row of
+    values per layer) can be given along with a list of their names as
+    value_name. Point geometries are only constructed (as a GeoDataFrame) if
+    with_geometry is True.'''
+
+    # Convert cell row and col to point x and y
+    x, y = pixel_centres(np.asarray(r), np.asarray(c), transform)
+
+    # Arrange values of each layer
+    if isinstance(value_name, str):
+        value_name, values = [value_name], [values]
+
+    # Construct dataframe from raster data (compact integer indices)
+    df = pd.DataFrame({'col': np.asarray(c, dtype=np.int32),
+                       'row': np.asarray(r, dtype=np.int32),
+                       **dict(zip(value_name, values)), 'x': x, 'y': y})
+    if with_geometry:
+        df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(x, y))
+
+    # Return result
+    return df
+
+
+# Open raster given as path, raster aggregated in memory or covariate stack
+def open_raster(raster):
+    ''' This function opens a raster file with rasterio, or returns an
+    AggregatedRaster or CovariateStack as is (all of which can be used as
+    context managers).'''
+    if isinstance(raster, (AggregatedRaster, CovariateStack)):
+        return raster
+    return rasterio.open(raster)
+
+
+# Fingerprint a raster given as path, raster aggregated in memory or stack
+def raster_fingerprint(raster):
+    if isinstance(raster, (AggregatedRaster, CovariateStack)):
+        return raster.fingerprint
+    return file_fingerprint(raster)
+
+
+# Get attribute of the admin bound of each grid point
+def grid_field(df, adm_level, field):
+    ''' This function returns the value of an attribute of the admin bounds
+    (e.g. the mapped_field) for each grid point, as a categorical whose
+    codes are looked up from the adm_code of the grid, such that attributes
+    are never copied to every grid point.'''
+
+    # Encode attribute of each admin bound
+    codes, uniques = pd.factorize(adm_level[field])
+
+    # Look up code of each grid point
+    return pd.Categorical.from_codes(codes[df['adm_code'].to_numpy()],
+                                     categories=uniques)
+
+
 # Get dataframe of grid points from raster and associate with admin bounds
 def associate_grid_to_bounds(raster, adm_level, mapped_field,
-                             remove_zeros=False, value_name='val'):
+                             remove_zeros=False, value_name='val',
+                             method=grid_method, with_geometry=True):
+    ''' This function extracts the values of a raster (a file, AggregatedRaster
+    or CovariateStack) within the bounds of each row of a GeoDataFrame, and
+    returns a dataframe of pixels with their location and the position of
+    their admin bound (adm_code, see grid_field), ordered by admin bound,
+    along with the list of mapped_field values without pixels. Bounds are
+    either burnt into a label grid at once ("rasterize") or window by window
+    ("windowed"), or masked one by one ("mask", see grid_method).'''
+
+    # Mask the raster with each bound separately if requested
+    if method == "mask":
+        if isinstance(raster, CovariateStack):
+            raise ValueError("Covariates require grid_method rasterize or windowed")
+        return _associate_grid_by_mask(raster, adm_level, mapped_field,
+                                       remove_zeros, value_name,
+                                       with_geometry)
+
+    # Label pixels, either in one pass or window by window
+    with open_raster(raster) as src:
+        transform = src.transform
+        if method == "windowed":
+            windows = raster_windows(src)
+        else:
+            windows = [rasterio.windows.Window(0, 0, src.width, src.height)]
+        adm_bounds = adm_level.geometry.bounds.to_numpy()
+        pixels = [
+            label_window(src, adm_level, window, adm_bounds, remove_zeros)
+            for window in windows
+            ]
+        value_names = [value_name] + list(getattr(src, "covariate_names", []))
+
+    # Collect pixels across all windows
+    r, c, values, labels = zip(*pixels)
+    r, c, labels = np.concatenate(r), np.concatenate(c), np.concatenate(labels)
+    values = np.concatenate(values, axis=1)
+
+    # Order pixels by admin bound, as when masking bound by bound
+    order = np.argsort(labels, kind="stable")
+    r, c, values, labels = r[order], c[order], values[:, order], labels[order]
+
+    # Construct dataframe from raster data
+    df = pixels_to_frame(r, c, values, transform, value_names, with_geometry)
+
+    # Reference admin bound of each pixel by its position in adm_level
+    df['adm_code'] = labels.astype(np.int32)
+
+    # Find bounds for which no pixels were found
+    has_pixels = np.bincount(labels, minlength=adm_level.shape[0]) > 0
+    exceptions = adm_level[mapped_field][~has_pixels].to_list()
+
+    # Return result
+    return df, exceptions
+
+
+# Get path of the cached grid association of a raster and admin bounds
+def grid_cache_path(raster, adm_level, mapped_field, remove_zeros=False,
+                    value_name='val', method=grid_method):
+    ''' This function returns the path within grid_cache_dir under which
+    cached_associate_grid_to_bounds stores the association of the given
+    inputs (whether it exists or not).'''
+    key = cache_key(
+        raster_fingerprint(raster), frame_fingerprint(adm_level), mapped_field,
+        res, remove_zeros, value_name, method, grid_layout
+        )
+    return os.path.join(grid_cache_dir, f"grid_{key[:16]}.{grid_cache_format}")
+
+
+# Get dataframe of grid points associated with admin bounds, using the cache
+def cached_associate_grid_to_bounds(raster, adm_level, mapped_field,
+                                    remove_zeros=False, value_name='val',
+                                    method=grid_method, with_geometry=True):
+    ''' This function returns the same result as associate_grid_to_bounds,
+    but persists the association to grid_cache_dir (Feather or Parquet, see
+    grid_cache_format) and reuses it as long as the raster, admin bounds and
+    parameters are unchanged. This avoids repeating the association for
+    each exposure group of the same country.'''
+
+    # Arrange cache path from all inputs
+    cache_path = grid_cache_path(raster, adm_level, mapped_field,
+                                 remove_zeros, value_name, method)
+    os.makedirs(grid_cache_dir, exist_ok=True)
+
+    # Load association from cache if available
+    if os.path.exists(cache_path):
+        touch(cache_path)
+        record("grid", "hit")
+        df, metadata = read_frame(cache_path)
+        exceptions = metadata["exceptions"]
+
+    # Otherwise associate grid and add to cache (without point geometry)
+    else:
+        record("grid", "miss")
+        df, exceptions = associate_grid_to_bounds(
+            raster, adm_level, mapped_field, remove_zeros, value_name, method,
+            with_geometry=False
+            )
+        df = df.reset_index(drop=True)
+        write_frame(df, cache_path, {"exceptions": exceptions})
+        evict_lru(grid_cache_dir, grid_cache_max_mb, keep=[cache_path],
+                  cache_name="grid")
+
+    # Print cache statistics
+    print_cache_stats(grid_cache_dir, "grid")
+
+    # Add point geometry if requested
+    if with_geometry:
+        df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['x'], df['y']))
+
+    # Return result
+    return df, exceptions
+
+
+# Get dataframe of grid points by masking raster with one bound at a time
+def _associate_grid_by_mask(raster, adm_level, mapped_field,
+                            remove_zeros=False, value_name='val',
+                            with_geometry=True):
     ''' This function iterates through all rows of a GeoDataFrame and extracts
     raster values within those bounds, then returns a dataframe with all raster
-    data associated with attributes from that GeoDataFrame and geolocation.
+    data, its geolocation and the position of its bound in the GeoDataFrame.
     Optional argument remove_zeros will remove values equal to 0 if set to
     True.'''
 
@@ -72,15 +490,21 @@ def associate_grid_to_bounds(raster, adm_level, mapped_field,
     # Initialize list for exceptions
     exceptions = []
 
+    # Hold raster aggregated in memory as dataset for rasterio.mask
+    if isinstance(raster, AggregatedRaster):
+        raster = raster.to_memfile()
+
     # Iterate through each boundary such that the boundary ID can be retained
-    for i, adm in adm_level.iterrows():
-        # Get geometry and extent of admin region
-        geom = adm.geometry
-        # If geometry is polygon, convert to list for rasterio.mask
-        if type(geom) == shapely.geometry.polygon.Polygon:
-            geom = [geom]
+    for i, (_, adm) in enumerate(adm_level.iterrows()):
+        # Get geometry of admin region as list for rasterio.mask (shapely 2
+        # geometries, including MultiPolygons, are not iterable)
+        geom = [adm.geometry]
         # Perform mask on raster data
-        with rasterio.open(raster) as src:
+        if isinstance(raster, rasterio.io.MemoryFile):
+            opened = raster.open()
+        else:
+            opened = rasterio.open(raster)
+        with opened as src:
             # Mask to boundary
             out_image, out_transform = rasterio.mask.mask(src, geom, crop=True)
             no_data = src.nodata
@@ -93,30 +517,13 @@ def associate_grid_to_bounds(raster, adm_level, mapped_field,
         else:
             r, c = np.where(data != no_data)
             values = np.extract(data != no_data, data)
-        # Convert cell row and col to point x and y
-        T1 = out_transform * Affine.translation(0.5, 0.5)  # ref. pixel centre
-        rc2xy = lambda r, c: (c, r) * T1
         # Construct dataframe from raster data
-        dfs[i] = gpd.GeoDataFrame({'col':c,'row':r, value_name:values})
-        # Implement try-except for cases where mask produces no pixels
-        if dfs[i].shape[0] > 0:
-            dfs[i]['x'] = dfs[i].apply(
-                lambda row: rc2xy(row.row, row.col)[0], axis=1
-                )
-            dfs[i]['y'] = dfs[i].apply(
-                lambda row: rc2xy(row.row, row.col)[1], axis=1
-                )
-            dfs[i]['geometry'] = dfs[i].apply(
-                lambda row: shapely.geometry.Point(row['x'], row['y']), axis=1
-                )
-            # Include information from vector data (admin bounds)
-            for col, val in adm.iteritems():
-                if col == "geometry":
-                    pass  # skip poly geom from admin bound, as this is pt data
-                else:
-                    dfs[i][col] = val
+        dfs[i] = pixels_to_frame(r, c, values, out_transform, value_name,
+                                 with_geometry)
+        # Reference admin bound by its position in adm_level
+        dfs[i]['adm_code'] = np.int32(i)
         # Warn user if mask produced no pixels
-        else:
+        if dfs[i].shape[0] == 0:
             # TODO: Figure out an approach to handle these exceptions
             exceptions.append(adm[mapped_field])
 
@@ -128,54 +535,72 @@ def associate_grid_to_bounds(raster, adm_level, mapped_field,
 
 
 # Added excepted bounds into dataframe and sample nearest
-def add_excepted_bounds(df, adm, important_exceptions, mapped_field):
+def add_excepted_bounds(df, adm, important_exceptions, mapped_field,
+                        grid_index=None, append=True):
     ''' This function handles the case where certain boundaries have no grid
     cell with corresponding data from the external datasets (e.g. WorldPop).
     This case might occur for small admin boundaries where the desired
     resolution (res) is too large and therefore no grid cell is associated with
     that boundary. Since there is no grid cell associated, the boundary's
-    representative_point will instead be used for the geolocation'''
+    representative_point will instead be used for the geolocation, and the
+    count of the nearest grid cell is used. All exceptions are handled at
+    once; grid_index (a GridIndex of the x/y of df) is built if not given.
+    If append is False, only the new rows are returned (e.g. to leave a
+    shared grid untouched).'''
 
-    # Get last index and create range of new indicies
+    # Get representative point and area of all exception bounds at once
+    adm_codes = np.flatnonzero(adm[mapped_field].isin(important_exceptions))
+    adm_new = adm.iloc[adm_codes]
+    area = adm_new.to_crs(area_crs).geometry.area.to_numpy()
+    point = adm_new.to_crs(desired_crs).geometry.representative_point()
+
+    # Keep larger entity if more than one matches the same mapped_field
+    points = pd.DataFrame({
+        mapped_field: adm_new[mapped_field].to_numpy(),
+        'adm_code': adm_codes.astype(np.int32),
+        'x': point.x.to_numpy(), 'y': point.y.to_numpy(), 'area': area
+        })
+    points = points.sort_values('area', ascending=False, kind='stable')
+    points = points.drop_duplicates(mapped_field).set_index(mapped_field)
+
+    # Keep exceptions in given order, skipping those without admin bound
+    missing = [e for e in important_exceptions if e not in points.index]
+    if missing:
+        print_yellow(f"WARNING: Could not find admin bounds for: {missing}")
+    exceptions = [e for e in important_exceptions if e in points.index]
+    points = points.loc[exceptions]
+
+    # Find count of nearest grid cell (replacing 0 values with small number)
+    if grid_index is None:
+        grid_index = GridIndex.from_frame(df)
+    _, nearest = grid_index.query(points['x'], points['y'])
+    count = df['count'].to_numpy()[nearest]
+    count = np.where(count == 0, 0.1, count)
+
+    # Construct new df with rows equal to exceptions (continuing the index),
+    # without raster cell (row and col of -1) or raster values (NaN)
     i_new = df.index[-1]
-    idx_new = list(range(i_new+1, i_new+1+len(important_exceptions)))
-
-    # Construct new df with rows equal to important_exceptions
-    df_new = pd.DataFrame(data={
-                                mapped_field: important_exceptions
-                            },
-                          columns=df.columns,
-                          index=idx_new
-                          )
-
-    # Construct geometry from centroid of adm level
-    for exception in important_exceptions:
-        # Get repr. point from matching mapped_field (dissolve in case of dup)
-        idx = (adm[mapped_field] == exception)
-        area = adm[idx].to_crs(area_crs).geometry.area
-        point = adm[idx].to_crs(desired_crs).geometry.representative_point()
-        x, y = point.x, point.y
-        # Check if more than one entity retrieved, and take larger if so
-        if point.shape[0] > 1:
-            i_larger = area.idxmax()
-            point, x, y = point[i_larger], x[i_larger], y[i_larger]
-        # Arrange in df_new
-        jdx = (df_new[mapped_field] == exception)
-        df_new.loc[jdx, 'x'] = float(x)
-        df_new.loc[jdx, 'y'] = float(y)
-
-    # Add geometry
-    df_new['geometry'] = df_new.apply(
-        lambda row: shapely.geometry.Point(row['x'], row['y']), axis=1
-        )
+    idx_new = list(range(i_new+1, i_new+1+len(exceptions)))
+    data = {
+        'adm_code': points['adm_code'].to_numpy(),
+        'x': points['x'].to_numpy(),
+        'y': points['y'].to_numpy(),
+        'count': count
+        }
+    for col in df.columns.drop(list(data) + ['geometry'], errors='ignore'):
+        fill = -1 if df[col].dtype.kind in 'iu' else np.nan
+        data[col] = np.full(len(exceptions), fill, dtype=df[col].dtype
+                            if df[col].dtype.kind in 'iuf' else object)
+    df_new = pd.DataFrame(data=data, columns=df.columns, index=idx_new)
 
-    # Find nearest smod_string and built_string from raster grid
-    df_new = ckdnearest(df_new, df, gdfB_cols=['count'])
-    # Maintain index and replace 0 values with small number
-    df_new.index = idx_new
-    df_new.loc[df_new['count'] == 0, 'count'] = 0.1
+    # Add geometry (only if grid carries geometry)
+    if 'geometry' in df.columns:
+        df_new = gpd.GeoDataFrame(
+            df_new.drop(columns='geometry'),
+            geometry=gpd.points_from_xy(df_new['x'], df_new['y'])
+            )
 
     # Append new dataframe rows
-    df = pd.concat([df, df_new], axis=0)
-
-    return df.copy()
+    if not append:
+        return df_new
+    return pd.concat([df, df_new], axis=0)
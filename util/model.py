@@ -1,23 +1,131 @@
 # Load dependencies
 from _config import *
+import numpy as np
+import pandas as pd
 
 
-# Write model to CSV for OQ
-def write_model(model, file_name, group):
-    ''' This function writes the resampled exposure model to a CSV in the
-    output_dir'''
+# Writer of exposure models for OQ, one part at a time
+class ModelWriter:
+    ''' This class writes the resampled exposure model to a file in the
+    output_dir, in the OpenQuake exposure layout. The model can be written
+    at once or in parts (e.g. one per admin bound, as they are sampled), such
+    that the full model never needs to be held in memory. Supported formats
+    are "csv" (written in chunks of csv_chunksize rows), "parquet" and
+    "feather"; the file extension of file_name is adjusted to the format.'''
+
+    def __init__(self, file_name, group, file_format=output_format,
+                 compression=output_compression):
+
+        # Arrange full path with extension matching the format
+        root, _ = os.path.splitext(file_name)
+        extension = {"csv": ".csv", "parquet": ".parquet",
+                     "feather": ".feather"}[file_format]
+        self.file_path = os.path.join(output_dir, root + extension)
+
+        # Keep settings
+        self.group = group.title()
+        self.file_format = file_format
+        self.compression = compression
+
+        # Initialize state
+        self.n_rows = 0
+        self.total_number = 0.0
+        self._index_offset = 0
+        self._schema = None
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Write one part of the model
+    def write(self, model):
+        ''' This function appends a part of the model to the file, numbering
+        the asset ids (and the index of each part) consecutively across
+        parts.'''
+
+        # Fill missing values (index continues from previous parts)
+        model = model.fillna(0)
+        model.index = model.index + self._index_offset
+        if model.shape[0] > 0:
+            self._index_offset = model.index.max() + 1
+        model = model.reset_index()
+
+        # Construct id column (numbered across parts)
+        ids = np.arange(self.n_rows, self.n_rows + model.shape[0])
+        model["id"] = self.group + "_" + pd.Series(ids).astype(str)
+
+        # FIXME: Handle this in a better way
+        model["occupancy"] = self.group
 
-    # Fill missing values
-    model = model.fillna(0).reset_index()
+        # Export part in desired format
+        if self.file_format == "csv":
+            self._write_csv(model)
+        else:
+            self._write_arrow(model)
 
-    # Construct id column
-    model["id"] = group.title() + "_" + model.index.astype(str)
+        # Update state
+        self.n_rows += model.shape[0]
+        self.total_number += model["number"].sum()
 
-    # FIXME: Handle this in a better way
-    model["occupancy"] = group.title()
+    # Append part to CSV, in chunks
+    def _write_csv(self, model):
+        for start in range(0, max(model.shape[0], 1), csv_chunksize):
+            first = (self.n_rows == 0 and start == 0)
+            model.iloc[start:start + csv_chunksize].to_csv(
+                self.file_path, mode="w" if first else "a", header=first,
+                index=False
+                )
+
+    # Append part to Parquet or Feather file
+    def _write_arrow(self, model):
+
+        # Import pyarrow only when used
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        # Use plain strings for categoricals, as dictionaries vary by part
+        for col in model.columns:
+            if isinstance(model[col].dtype, pd.CategoricalDtype):
+                model[col] = model[col].astype(str)
+
+        # Convert to arrow table, using the schema of the first part
+        table = pa.Table.from_pandas(model, schema=self._schema,
+                                     preserve_index=False)
+
+        # Open file with first part
+        if self._writer is None:
+            self._schema = table.schema
+            if self.file_format == "parquet":
+                self._writer = pyarrow.parquet.ParquetWriter(
+                    self.file_path, self._schema, compression=self.compression
+                    )
+            else:
+                options = pa.ipc.IpcWriteOptions(compression=self.compression)
+                self._writer = pa.ipc.new_file(self.file_path, self._schema,
+                                               options=options)
+
+        # Write part
+        self._writer.write_table(table)
+
+    # Close file
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+# Write model to CSV for OQ
+def write_model(model, file_name, group, file_format=output_format):
+    ''' This function writes the resampled exposure model to a CSV (or, see
+    output_format, a Parquet or Feather file) in the output_dir'''
 
-    # Arrange full path
-    file_path = os.path.join(output_dir, file_name)
+    # Write entire model as a single part
+    with ModelWriter(file_name, group, file_format) as writer:
+        writer.write(model)
 
-    # Export df to csv
-    model.to_csv(file_path, index=False)
+    # Return full path
+    return writer.file_path
@@ -0,0 +1,204 @@
+# Load dependencies
+from _config import *
+import time
+import json
+import copy
+import threading
+from contextlib import contextmanager
+
+
+# Get current resident set size (RSS) of the process in bytes
+def current_rss():
+    ''' This function returns the current RSS of the process (from /proc,
+    e.g. on Linux), or None where it cannot be measured.'''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Get peak RSS of the process over its lifetime in bytes
+def lifetime_peak_rss():
+    ''' This function returns the peak RSS of the process since it started
+    (e.g. on macOS, where the current RSS is unavailable), or None where it
+    cannot be measured (e.g. on Windows).'''
+
+    # Import resource only when used, as it is unavailable on Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # Peak RSS is in bytes on macOS, and in kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Track peak RSS while a stage runs
+class PeakMemory:
+    ''' This class samples the RSS of the process in a background thread
+    every interval seconds while used as a context manager, and records the
+    peak RSS (peak_mb) and its increase over the RSS at the start of the
+    stage (delta_mb). Unlike tracemalloc, this includes memory allocated by
+    GDAL and does not slow down the measured code. Where the current RSS
+    cannot be measured, peak_mb is the lifetime peak of the process and
+    delta_mb is None (both are None if neither can be measured).'''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.peak_mb = self.delta_mb = None
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+
+        # Fall back to lifetime peak if current RSS is unavailable
+        if self._thread is None:
+            peak = lifetime_peak_rss()
+            if peak is not None:
+                self.peak_mb = peak / 1024**2
+            return
+
+        # Otherwise stop sampling
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss() or 0)
+        self.peak_mb = self.peak / 1024**2
+        self.delta_mb = (self.peak - self.start) / 1024**2
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+
+# Collector of per-stage (and per-bound) timing and memory
+class Profiler:
+    ''' This class records the wall time, CPU time, peak RSS and number of
+    rows of each stage of a run, and (if bounds is True) the time spent on
+    each admin bound. Stages are measured with the stage context manager,
+    which yields a dict to which further fields (e.g. "rows") can be added.
+    The records are written as a machine-readable report with write.'''
+
+    def __init__(self, bounds=profile_bounds, **info):
+        self.info = info
+        self.bounds = bounds
+        self.stages = []
+        self.bound_records = []
+
+    # Measure one stage
+    @contextmanager
+    def stage(self, name):
+        record = {"stage": name, "rows": None}
+        wall, cpu = time.perf_counter(), time.process_time()
+        with PeakMemory() as memory:
+            try:
+                yield record
+            finally:
+                record["wall_seconds"] = time.perf_counter() - wall
+                record["cpu_seconds"] = time.process_time() - cpu
+        record["peak_rss_mb"] = memory.peak_mb
+        record["delta_rss_mb"] = memory.delta_mb
+        self.stages.append(record)
+
+    # Record time spent on one admin bound
+    def bound(self, name, seconds, rows, reused=False):
+        if self.bounds:
+            self.bound_records.append({
+                "bound": str(name), "seconds": seconds, "rows": rows,
+                "reused": reused
+                })
+
+    # Copy (e.g. to share stages of a grid between groups)
+    def copy(self, **info):
+        profiler = copy.deepcopy(self)
+        profiler.info.update(info)
+        return profiler
+
+    # Write report
+    def write(self, file_name, file_format=profile_format):
+        ''' This function writes the records to profile_dir, either as a
+        single JSON file (with the run info, stages and bounds) or as CSV
+        files of the stages and (if recorded) bounds. Returns the path of the
+        (stages) report.'''
+
+        # Arrange full path
+        os.makedirs(profile_dir, exist_ok=True)
+        root = os.path.join(profile_dir, os.path.splitext(file_name)[0])
+
+        # Write report in desired format
+        if file_format == "json":
+            file_path = root + ".json"
+            with open(file_path, "w") as f:
+                json.dump({"info": self.info, "stages": self.stages,
+                           "bounds": self.bound_records}, f, indent=2,
+                          default=str)
+        else:
+            # Import pandas only when used
+            import pandas as pd
+            file_path = root + "_stages.csv"
+            pd.DataFrame(self.stages).assign(**self.info).to_csv(
+                file_path, index=False
+                )
+            if self.bound_records:
+                pd.DataFrame(self.bound_records).to_csv(
+                    root + "_bounds.csv", index=False
+                    )
+
+        # Return full path
+        return file_path
+
+
+# Progress reporter for long loops
+class Progress:
+    ''' This class reports the progress of a loop over total items, instead
+    of printing every item. In "bar" mode a single line is updated in place,
+    in "log" mode a line is printed at most every interval seconds, and in
+    "none" mode nothing is printed. A final line is printed on close.'''
+
+    def __init__(self, total, desc, mode=progress_mode,
+                 interval=progress_interval):
+        self.total = total
+        self.desc = desc
+        self.mode = mode
+        self.interval = interval
+        self.n = 0
+        self._start = self._last = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Advance by n items, reporting if due
+    def update(self, n=1, item=None):
+        self.n += n
+        now = time.perf_counter()
+        if self.mode == "none" or now - self._last < self.interval:
+            return
+        self._last = now
+        self._report(now, item)
+
+    # Print progress line
+    def _report(self, now, item=None, end=None):
+        elapsed = now - self._start
+        line = f"{self.desc}: {self.n}/{self.total} ({elapsed:0.1f} seconds)"
+        if item is not None:
+            line += f" - {item}"
+        if self.mode == "bar":
+            print("\r" + line, end="\n" if end else "", flush=True)
+        else:
+            print(line, flush=True)
+
+    # Report final state
+    def close(self):
+        if self.mode != "none":
+            self._report(time.perf_counter(), end=True)
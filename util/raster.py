@@ -0,0 +1,413 @@
+# Load dependencies
+from _config import *
+import numpy as np
+import scipy.sparse
+import rasterio as rio
+import rasterio.io
+import rasterio.windows
+from rasterio import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from util.cache import file_fingerprint, cache_key
+
+
+# Tolerance (in source pixels) below which a factor is treated as an integer
+factor_tolerance = 1e-3
+
+
+# Get aggregation factor from source resolution to desired resolution
+def aggregation_factor(src_res, res):
+    ''' This function returns the number of source pixels per output pixel
+    along one axis, rounded to an integer if it is within factor_tolerance
+    of one (e.g. 3 arcsec WorldPop aggregated to 0.05 degrees).'''
+
+    # Compute factor
+    factor = abs(res / src_res)
+    if factor < 1:
+        raise ValueError(f"Resolution {res} is finer than the raster "
+                         f"resolution {abs(src_res)}")
+
+    # Snap to integer if close enough
+    if abs(factor - round(factor)) * max(factor, 1) < factor_tolerance:
+        factor = int(round(factor))
+
+    # Return result
+    return factor
+
+
+# Arrange sparse matrix of overlap between source and output pixels
+def overlap_weights(n_src, factor, out_start, out_end, src_start):
+    ''' This function returns a sparse matrix (out_end - out_start rows,
+    n_src columns) holding the fraction of each source pixel (offset by
+    src_start) covered by each output pixel along one axis, where every
+    output pixel spans factor source pixels. Multiplying by this matrix
+    distributes each source value by area, such that sums are preserved.'''
+
+    # Get extent of each output pixel in source pixels
+    out = np.arange(out_start, out_end)
+    lo, hi = out * factor - src_start, (out + 1) * factor - src_start
+
+    # Get range of overlapping source pixels of each output pixel
+    first = np.floor(lo).astype(np.int64)
+    last = np.minimum(np.ceil(hi).astype(np.int64), n_src)
+    n = last - first
+
+    # Compute overlap of each (output, source) pair
+    rows = np.repeat(np.arange(out.shape[0]), n)
+    cols = np.repeat(first, n) + (np.arange(n.sum()) -
+                                  np.repeat(np.cumsum(n) - n, n))
+    weights = (np.minimum(cols + 1, np.repeat(hi, n)) -
+               np.maximum(cols, np.repeat(lo, n)))
+
+    # Return result
+    return scipy.sparse.csr_matrix((weights, (rows, cols)),
+                                   shape=(out.shape[0], n_src))
+
+
+# Aggregate a block of rows by an integer factor
+def aggregate_integer(data, valid, fy, fx, how):
+    ''' This function aggregates an array by integer factors fy (rows) and fx
+    (columns) by reshaping it into blocks and reducing each block, ignoring
+    invalid pixels. Rows and columns are padded (as invalid) to a multiple
+    of the factors. Returns the aggregated values and the number of valid
+    source pixels of each output pixel.'''
+
+    # Pad to full blocks
+    h, w = data.shape
+    pad = ((0, -h % fy), (0, -w % fx))
+    data = np.pad(data, pad)
+    valid = np.pad(valid, pad)
+    shape = (data.shape[0] // fy, fy, data.shape[1] // fx, fx)
+
+    # Reduce blocks
+    count = valid.reshape(shape).sum(axis=(1, 3), dtype=np.float64)
+    if how == "max":
+        values = np.where(valid, data, -np.inf).reshape(shape).max(axis=(1, 3))
+    else:
+        values = np.where(valid, data, 0).reshape(shape).sum(
+            axis=(1, 3), dtype=np.float64
+            )
+
+    # Return result
+    return values, count
+
+
+# Aggregate a block of rows by area weighting
+def aggregate_weighted(data, valid, row_weights, col_weights, how):
+    ''' This function aggregates an array onto a coarser grid given sparse
+    overlap weights of rows and columns (see overlap_weights), ignoring
+    invalid pixels. Sums are distributed by area; max takes the maximum of
+    all overlapping pixels. Returns the aggregated values and the valid
+    area (in source pixels) of each output pixel.'''
+
+    # Get valid area of each output pixel
+    valid_f = valid.astype(np.float64)
+    count = (col_weights @ (row_weights @ valid_f).T).T
+
+    # Take maximum over overlapping rows, then columns
+    if how == "max":
+        masked = np.where(valid, data, -np.inf)
+        values = np.full((row_weights.shape[0], col_weights.shape[0]),
+                         -np.inf)
+        rows = np.full((row_weights.shape[0], data.shape[1]), -np.inf)
+        for i in range(row_weights.shape[0]):
+            j = row_weights.indices[row_weights.indptr[i]:
+                                    row_weights.indptr[i + 1]]
+            if j.size:
+                rows[i] = masked[j].max(axis=0)
+        for i in range(col_weights.shape[0]):
+            j = col_weights.indices[col_weights.indptr[i]:
+                                    col_weights.indptr[i + 1]]
+            if j.size:
+                values[:, i] = rows[:, j].max(axis=1)
+
+    # Otherwise distribute values by area
+    else:
+        values = np.where(valid, data, 0).astype(np.float64)
+        values = (col_weights @ (row_weights @ values).T).T
+
+    # Return result
+    return values, count
+
+
+# Get output grid of a raster aggregated to a coarser resolution
+def aggregated_grid(src, res):
+    ''' This function returns the aggregation factors along columns and rows
+    (see aggregation_factor) of an open raster, and the width, height and
+    affine transform of the output grid at resolution res, which covers the
+    full source extent.'''
+
+    # Get factors
+    t = src.transform
+    fx, fy = aggregation_factor(t.a, res), aggregation_factor(t.e, res)
+
+    # Get output grid
+    width = int(np.ceil(src.width / fx - factor_tolerance))
+    height = int(np.ceil(src.height / fy - factor_tolerance))
+    transform = Affine(t.a * fx, t.b, t.c, t.d, t.e * fy, t.f)
+
+    # Return result
+    return fx, fy, width, height, transform
+
+
+# Get nodata value of an aggregated raster
+def aggregated_nodata(src):
+    ''' This function returns the nodata value of an open raster, or
+    -99999.0 if it has none, which is used for output pixels without any
+    valid source pixel.'''
+    return src.nodata if src.nodata is not None else -99999.0
+
+
+# Aggregate a range of output rows of an open raster
+def aggregate_rows(src, res, how, row_start, row_end, max_memory=max_memory_mb):
+    ''' This function aggregates the output rows row_start to row_end of an
+    open raster at the coarser resolution res (see aggregate_raster), reading
+    only the source rows they cover, in blocks within max_memory (in MB).
+    Averages and nodata are applied block by block, such that no array
+    beyond the requested rows is held. Returns the aggregated rows.'''
+
+    # Get output grid and nodata value
+    fx, fy, width, _, _ = aggregated_grid(src, res)
+    no_data = aggregated_nodata(src)
+    integer = isinstance(fx, int) and isinstance(fy, int)
+
+    # Get number of output rows per block (source values, validity mask
+    # and intermediate float64 arrays)
+    row_bytes = src.width * (np.dtype(src.dtypes[0]).itemsize + 1 + 24)
+    n_out = max(1, int(max_memory * 1024**2 // (row_bytes * fy)))
+
+    # Arrange column weights once
+    if not integer:
+        col_weights = overlap_weights(src.width, fx, 0, width, 0)
+
+    # Aggregate block by block
+    values = np.empty((row_end - row_start, width), dtype=np.float64)
+    for o0 in range(row_start, row_end, n_out):
+        o1 = min(o0 + n_out, row_end)
+
+        # Read source rows covered by output rows
+        s0 = int(np.floor(o0 * fy))
+        s1 = min(int(np.ceil(o1 * fy)), src.height)
+        window = rasterio.windows.Window(0, s0, src.width, s1 - s0)
+        data = src.read(1, window=window)
+        valid = np.ones(data.shape, dtype=bool)
+        if src.nodata is not None:
+            valid &= (data != src.nodata)
+        if data.dtype.kind == "f":
+            valid &= ~np.isnan(data)
+
+        # Aggregate block
+        if integer:
+            block, count = aggregate_integer(data, valid, fy, fx, how)
+        else:
+            row_weights = overlap_weights(s1 - s0, fy, o0, o1, s0)
+            block, count = aggregate_weighted(data, valid, row_weights,
+                                              col_weights, how)
+
+        # Average valid pixels if requested, and set output pixels without
+        # valid source pixels to nodata
+        if how == "mean":
+            np.divide(block, count, out=block, where=count > 0)
+        block[count == 0] = no_data
+        values[o0 - row_start:o1 - row_start] = block
+
+    # Return result
+    return values
+
+
+# Aggregate raster to a coarser resolution in memory
+def aggregate_raster(raster, res, how="sum", max_memory=max_memory_mb):
+    ''' This function aggregates a raster (e.g. WorldPop) to the coarser
+    resolution res, entirely in memory and without GDAL. Integer factors
+    are aggregated by reshaping pixels into blocks; other factors by area
+    weighting, such that each source pixel contributes in proportion to its
+    overlap with each output pixel. Nodata pixels are ignored, and output
+    pixels without any valid source pixel are set to nodata (see
+    aggregated_nodata). With how "sum" population totals are preserved,
+    "mean" averages valid pixels (as the GDAL "average" resampling) and
+    "max" takes their maximum. The source is read in blocks of rows within
+    max_memory (in MB). Returns the aggregated array, its affine transform,
+    CRS and nodata value.'''
+
+    # Check aggregation
+    if how not in ("sum", "mean", "max"):
+        raise ValueError(f"Unknown aggregation {how}, use sum, mean or max")
+
+    # Aggregate all output rows
+    with rio.open(raster) as src:
+        _, _, _, height, transform = aggregated_grid(src, res)
+        values = aggregate_rows(src, res, how, 0, height, max_memory)
+        crs, no_data = src.crs, aggregated_nodata(src)
+
+    # Return result
+    return values, transform, crs, no_data
+
+
+# Raster aggregated in memory, read like a rasterio dataset
+class AggregatedRaster:
+    ''' This class holds a raster aggregated to the resolution res by
+    aggregate_raster, and can be used in place of an open rasterio dataset
+    (read, window_transform, transform, width, height, nodata, ...) by the
+    grid association, such that no intermediate GeoTIFF is written. The
+    aggregation runs on first use, so it is skipped altogether if the grid
+    association is reused from the cache (see fingerprint). Windows read
+    before the whole raster is loaded are aggregated on their own (see
+    aggregate_rows), such that the "windowed" grid association never holds
+    the full aggregated grid.'''
+
+    def __init__(self, raster, res, how="sum"):
+        if how not in ("sum", "mean", "max"):
+            raise ValueError(f"Unknown aggregation {how}, use sum, mean or max")
+        self.raster = raster
+        self.res = res
+        self.how = how
+        self.fingerprint = cache_key(file_fingerprint(raster), res, how,
+                                     "aggregated")
+        self.transform = None
+        self._data = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        pass
+
+    # Get grid of the aggregated raster, without aggregating it (once)
+    def open(self):
+        if self.transform is None:
+            with rio.open(self.raster) as src:
+                _, _, self.width, self.height, self.transform = (
+                    aggregated_grid(src, self.res)
+                    )
+                self.crs, self.nodata = src.crs, aggregated_nodata(src)
+            self.count = 1
+            self.dtypes = ("float64",)
+            self.block_shapes = [(1, self.width)]
+        return self
+
+    # Aggregate raster (once)
+    def load(self):
+        self.open()
+        if self._data is None:
+            with rio.open(self.raster) as src:
+                self._data = aggregate_rows(src, self.res, self.how, 0,
+                                            self.height)
+        return self
+
+    # Read (a window of) the aggregated values, as 2D array if indexes is
+    # a band number or as 3D array otherwise (as rasterio)
+    def read(self, indexes=None, window=None):
+        if window is None or self._data is not None:
+            data = self.load()._data
+            if window is not None:
+                (r0, r1), (c0, c1) = window.toranges()
+                data = data[r0:r1, c0:c1]
+        else:
+            # Aggregate rows of window only
+            (r0, r1), (c0, c1) = window.toranges()
+            with rio.open(self.raster) as src:
+                data = aggregate_rows(src, self.res, self.how, r0,
+                                      min(r1, self.open().height))
+            data = data[:, c0:c1]
+        if isinstance(indexes, int):
+            return data
+        return data[np.newaxis]
+
+    # Get affine transform of a window
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.open().transform)
+
+    # Open aggregated raster as a rasterio dataset held in memory
+    def to_memfile(self):
+        self.load()
+        memfile = rasterio.io.MemoryFile()
+        with memfile.open(driver="GTiff", height=self.height,
+                          width=self.width, count=1, dtype=self.dtypes[0],
+                          crs=self.crs, transform=self.transform,
+                          nodata=self.nodata) as dst:
+            dst.write(self._data, 1)
+        return memfile
+
+
+# Stack of covariate rasters co-registered to a target grid
+class CovariateStack:
+    ''' This class stacks covariate rasters (e.g. built-up surface,
+    settlement class, night lights) on top of a target raster (a path or an
+    AggregatedRaster, e.g. of WorldPop), such that the grid association
+    reads all layers of a window at once and associates them with admin
+    bounds in a single pass. covariates maps the name of each layer to the
+    path of its raster and the aggregation used to co-register it to the
+    target grid ("sum", "mean", "max", "mode" or "nearest"), which is done on
+    the fly by a WarpedVRT (also reprojecting if needed). Reads return
+    float64 arrays with the target first, where covariate nodata (or areas
+    outside a covariate) are NaN. Used as a context manager, it opens all
+    rasters on entry and closes them on exit.'''
+
+    def __init__(self, raster, covariates):
+        self.raster = raster
+        self.covariates = covariates
+        self.covariate_names = list(covariates)
+        self.count = 1 + len(covariates)
+        self.dtypes = ("float64",) * self.count
+
+        # Fingerprint target and covariates (see cached grid association)
+        if isinstance(raster, AggregatedRaster):
+            target = raster.fingerprint
+        else:
+            target = file_fingerprint(raster)
+        self.fingerprint = cache_key(target, *[
+            (name, file_fingerprint(path), how)
+            for name, (path, how) in covariates.items()
+            ])
+        self._sources = []
+
+    def __enter__(self):
+
+        # Open target and take its grid
+        if isinstance(self.raster, AggregatedRaster):
+            self._target = self.raster.open()
+        else:
+            self._target = rio.open(self.raster)
+            self._sources.append(self._target)
+        for attr in ("transform", "crs", "width", "height", "nodata",
+                     "block_shapes"):
+            setattr(self, attr, getattr(self._target, attr))
+
+        # Co-register covariates to target grid
+        self._layers = []
+        for path, how in self.covariates.values():
+            src = rio.open(path)
+            resampling = getattr(Resampling, {"mean": "average"}.get(how, how))
+            vrt = WarpedVRT(src, crs=self.crs, transform=self.transform,
+                            width=self.width, height=self.height,
+                            resampling=resampling)
+            self._sources.extend([vrt, src])
+            self._layers.append(vrt)
+
+        return self
+
+    def __exit__(self, *args):
+        for src in self._sources:
+            src.close()
+        self._sources = []
+
+    # Read (a window of) all layers as 3D array (or one band as 2D array)
+    def read(self, indexes=None, window=None):
+
+        # Read target and covariates
+        layers = [self._target.read(1, window=window).astype(np.float64)]
+        for vrt in self._layers:
+            data = vrt.read(1, window=window, masked=True)
+            layers.append(data.astype(np.float64).filled(np.nan))
+        data = np.stack(layers)
+
+        # Return requested bands
+        if isinstance(indexes, int):
+            return data[indexes - 1]
+        if indexes is not None:
+            return data[[i - 1 for i in indexes]]
+        return data
+
+    # Get affine transform of a window
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.transform)
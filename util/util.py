@@ -1,5 +1,6 @@
 # Load dependencies
 from _config import *
+import math
 
 
 # Print red text